@@ -37,6 +37,7 @@ export LD_LIBRARY_PATH=$HDF5_PARALLEL_DIR/lib:$PYTHON3_DIR/lib:$LD_LIBRARY_PATH
 gamma=0.05
 bm_name=basal_melt
 bm_file=$bm_name.2d.hdf5
+bm_inputs=$bm_name.inputs
 
 echo "leg number: $leg_number, exp_name: $exp_name, start_dir: $start_dir, run_dir: $run_dir"
 
@@ -54,7 +55,7 @@ NC2AMR="$BISICLES_HOME/code/filetools/nctoamr2d.Linux.64.mpiCC.mpif90.DEBUG.OPT.
 DRIVER="$BISICLES_HOME/code/exec2D/driver2d.Linux.64.mpiCC.mpif90.DEBUG.OPT.MPI.PETSC.ex"
 
 ### 4. Run basal melt python script    
-python3 $start_dir/BasalMeltCoupling/compute_basalmelt.py $exp_name $gamma $bm_name $start_dir $outpath $nemo_output $NC2AMR ${num} || exit
+python3 $start_dir/BasalMeltCoupling/compute_basalmelt.py $exp_name $gamma $bm_name $start_dir $outpath $nemo_output $NC2AMR $leg_start_date || exit
 
 ### 5. Define new basal melt values in input files 
 COUPLED_TEMPLATE="$start_dir/BasalMeltCoupling/BISICLES_submission_template.slurm"
@@ -62,6 +63,7 @@ export COUPLED=$start_dir/BasalMeltCoupling/BISICLES_submission.slurm
 cp $COUPLED_TEMPLATE $COUPLED
 
 sed -i s+@melt+$bm_file+ $COUPLED
+sed -i s+@bminputs+$bm_inputs+ $COUPLED
 sed -i s+@exp+$exp_name+ $COUPLED
 sed -i s+@out+$outpath+ $COUPLED
 sed -i s+@driver+$DRIVER+ $COUPLED
@@ -93,7 +95,7 @@ echo "...BISICLES done!"
 if test -n "$(find $plots -type f -name "plot.$exp_name.??????.2d.hdf5" -print -quit)"
     then
     echo "Found plot, calculating freshwater"
-    python3 $start_dir/BasalMeltCoupling/compute_freshwater.py $exp_name $start_dir $FLATTEN $outpath $nemo_output ${num} || exit
+    python3 $start_dir/BasalMeltCoupling/compute_freshwater.py $exp_name $start_dir $FLATTEN $outpath $nemo_output $leg_start_date || exit
     cp -p $run_dir/output/bisicles/csv/freshwater_forcing.nc $start_dir/BasalMeltCoupling/inputs/forcing/$exp_name/FWF_LRF_y${leg_end_date}.nc
     else
     echo "Something went wrong, no plot"
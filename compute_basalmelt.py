@@ -4,15 +4,17 @@ This script calculates basal melt for the Levermann regions,
 based on an EC-Earth ocean temperature file and maps them 
 to a BISICLES AMR file
 
-This script requires paths to EC-Earth area and ocean temperature files,
+This script requires paths to EC-Earth area and ocean temperature files
+(all grid_T_3D files of the leg are averaged),
 path to levermann region maks, chosen gamma value and path to bisisles nc2amr tool.
 Requires the BasalMelt module.
 """
 
 import os
 import sys
-from glob import iglob
+from glob import glob, iglob
 from freshwater_coupling import basal_melt as BM
+from freshwater_coupling.monitoring import Monitoring
 
 # Define parameters
 EXP_NAME = str(sys.argv[1])
@@ -28,16 +30,36 @@ NC_OUT = OUTPATH + "/plots/nc/"
 PLOT_PATH = OUTPATH + "/plots/hdf5/"
 CSV_OUT = OUTPATH + "/csv/"
 CHK_OUT = OUTPATH + "/checkpoints/"
+MONITORING_OUT = CSV_OUT + "monitoring/"
 
 AREA_FILE = (
     PATH + "/inputs/ec-earth_data/areacello_Ofx_EC-Earth3_historical_r1i1p1f1_gn.nc"
 )
 
+# Sector baselines written by compute_baseline.py
+BASELINE_FILE = PATH + "/inputs/ec-earth_data/OceanSectorThetaoBaseline_piControl.csv"
+
 NEMO_PATH = str(sys.argv[6])
-THETAO_FILE = sorted(iglob(NEMO_PATH + "*_grid_T_3D.nc"))[0]
+THETAO_FILES = sorted(iglob(NEMO_PATH + "*_grid_T_3D.nc"))
 
-# Load leverman masks (Maybe in future should just be replaces with coordinates)
+# Levermann region labels are derived from the sector coordinates when
+# MASK_PATH contains no mask files
 DRIVER = str(sys.argv[7])
+LEG_YEAR = int(sys.argv[8])
+
+# Time between basal melt rows in years. None writes a single record,
+# otherwise every row is written as a numbered record and NAME.inputs
+# holds the matching basalFlux.floating entries
+FORCING_TIME_STEP = None
+
+# Compute basal melt for every thetao record instead of the annual mean,
+# used with a FORCING_TIME_STEP matching the ocean output frequency
+TIME_RESOLVED = False
+
+# Length of a leg in years, BISICLES runs one leg from main.maxTime minus
+# LEG_LENGTH to main.maxTime
+LEG_LENGTH = 1.0
+
 
 def new_path(path_name):
     if not os.path.exists(path_name):
@@ -45,14 +67,46 @@ def new_path(path_name):
     return path_name
 
 
+def leg_start_time(chk_path, plot_path):
+    """BISICLES model time at the start of the leg. BISICLES restarts with
+    amr.restart_set_time=false, so its time keeps counting over the legs.
+    The submission template runs to main.maxTime = @TIME, counted from the
+    checkpoint and plot files in the same way here.
+    Args:
+        chk_path (str): path to BISICLES checkpoint files
+        plot_path (str): path to BISICLES plot files
+    Returns:
+        start time (float) of the leg in years
+    """
+    count = len(glob(chk_path + "chk.*"))
+    plot_count = len(glob(plot_path + "plot.*"))
+    if count == 0:
+        plot_count = plot_count + 1
+    return plot_count - LEG_LENGTH
+
+
 # Calculate basal melt
 if __name__ == "__main__":
     OUTPUT_NC = new_path(NC_OUT)
     OUTPUT_PLOT = new_path(PLOT_PATH)
     OUTPUT_CSV = new_path(CSV_OUT)
     OUTPUT_CHK = new_path(CHK_OUT)
-    OCEAN_TEMP = BM.BasalMelt(THETAO_FILE, AREA_FILE, GAMMA)
-    BASAL_MELT = OCEAN_TEMP.map_basalmelt(MASK_PATH, OUTPATH, DRIVER, NAME)
+    OCEAN_TEMP = BM.BasalMelt(
+        THETAO_FILES, AREA_FILE, GAMMA, baseline_file=BASELINE_FILE
+    )
+    BASAL_MELT = OCEAN_TEMP.map_basalmelt(
+        MASK_PATH,
+        OUTPATH,
+        DRIVER,
+        NAME,
+        time_step=FORCING_TIME_STEP,
+        start_time=leg_start_time(OUTPUT_CHK, OUTPUT_PLOT),
+        time_resolved=TIME_RESOLVED,
+    )
     BM_CSV = OUTPUT_CSV + EXP_NAME + "_bm.csv"
     BASAL_MELT.to_csv(BM_CSV, mode="a", header=not os.path.exists(BM_CSV))
+    if not TIME_RESOLVED:
+        Monitoring(MONITORING_OUT, EXP_NAME, name="ocean").update(
+            LEG_YEAR, thetao=OCEAN_TEMP.sector_temperatures(), basal_melt=BASAL_MELT
+        )
     print("Basal Melt Calculated")
@@ -0,0 +1,33 @@
+"""Baseline Calculation
+
+This script calculates the piControl baseline ocean temperature of the
+Levermann regions, used by compute_basalmelt.py to calculate basal melt
+anomalies.
+
+This script requires the path to the EC-Earth piControl ocean temperature
+files, the area file and the name of the baseline table to write,
+compute_basalmelt.py reads it from
+inputs/ec-earth_data/OceanSectorThetaoBaseline_piControl.csv.
+Requires the Baseline module.
+"""
+
+import sys
+from glob import iglob
+from freshwater_coupling.baseline import Baseline
+
+# Define paths
+PICONTROL_PATH = str(sys.argv[1])
+AREA_FILE = str(sys.argv[2])
+BASELINE_FILE = str(sys.argv[3])
+
+THETAO_FILES = sorted(iglob(PICONTROL_PATH + "/*_grid_T_3D.nc"))
+CHECKPOINT_FILE = BASELINE_FILE + ".checkpoint.json"
+MAX_WORKERS = None  # one process per cpu
+
+# Calculate baseline
+if __name__ == "__main__":
+    BASELINE = Baseline(
+        THETAO_FILES, AREA_FILE, checkpoint=CHECKPOINT_FILE, max_workers=MAX_WORKERS
+    )
+    print(BASELINE.write(BASELINE_FILE))
+    print("Baseline Calculated")
@@ -11,11 +11,14 @@ Requires the Freshwater modules and glob
 import sys
 import os
 from glob import iglob
+import pandas as pd
 from freshwater_coupling import freshwater as FW
+from freshwater_coupling.monitoring import Monitoring
 
 # Define parameters
 EXP_NAME = str(sys.argv[1])
 YEAR_MIN = 2015
+FLATTEN_TIMEOUT = 1800  # [s] per plot file
 
 # Define paths
 PATH = str(sys.argv[2]) + "/BasalMeltCoupling"
@@ -26,6 +29,15 @@ AREA_FILE = (
     PATH + "/inputs/ec-earth_data/areacello_Ofx_EC-Earth3_historical_r1i1p1f1_gn.nc"
 )
 
+# Baseline total freshwater forcing of each region, one row with a column
+# per region (e.g. the mean TotalFreshwaterForcing of a piControl run). The
+# CumulativeFreshwaterForcingAnomaly product is only written when it exists
+FRESHWATER_BASELINE_FILE = (
+    PATH + "/inputs/ec-earth_data/FreshwaterBaseline_piControl.csv"
+)
+if not os.path.exists(FRESHWATER_BASELINE_FILE):
+    FRESHWATER_BASELINE_FILE = None
+
 BM_MASK_FILE = PATH + "/inputs/ec-earth_data/basal_melt_mask_ORCA1_ocean.nc"
 CALVING_MASK_FILE = PATH + "/inputs/ec-earth_data/calving_mask_ORCA1_ocean.nc"
 
@@ -33,26 +45,52 @@ OUTPATH = str(sys.argv[4])
 NC_OUT = OUTPATH + "/plots/nc/"
 PLOT_PATH = OUTPATH + "/plots/hdf5/"
 CSV_OUT = OUTPATH + "/csv/"
+MONITORING_OUT = CSV_OUT + "monitoring/"
 
 NEMO_PATH = str(sys.argv[5])
 THETAO_FILE = sorted(iglob(NEMO_PATH + "*_grid_T_3D.nc"))[0]
+LEG_YEAR = int(sys.argv[6])
+
+
+def append_csv(data_df, csv_file):
+    """Append rows to a csv file, in the column order of its header when
+    the file exists, so experiments started with another region order
+    keep their values under the right names
+    Args:
+        data_df (pandas dataframe): rows to append
+        csv_file (str): name of csv file
+    """
+    if os.path.exists(csv_file):
+        columns = pd.read_csv(csv_file, index_col=0, nrows=0).columns
+        assert set(columns) == set(data_df.columns), "Regions changed"
+        data_df = data_df[list(columns)]
+    data_df.to_csv(csv_file, mode="a", header=not os.path.exists(csv_file))
+
 
 if __name__ == "__main__":
     PENULTIMATE_FILE = sorted(iglob(PLOT_PATH + "*.2d.hdf5"), reverse=True)[1]
     LATEST_FILE = sorted(iglob(PLOT_PATH + "*.2d.hdf5"), reverse=True)[0]
     print(PENULTIMATE_FILE, LATEST_FILE) # Test here instead
 
-    FRESHWATER = FW.Freshwater(FLATTEN, PENULTIMATE_FILE, LATEST_FILE)
+    FRESHWATER = FW.Freshwater(
+        FLATTEN, PENULTIMATE_FILE, LATEST_FILE, timeout=FLATTEN_TIMEOUT
+    )
     DISCHARGE, BASAL = FRESHWATER.regional_contribution(MASK_PATH, NC_OUT, FLATTEN)
 
     F_DISCHARGE = CSV_OUT + EXP_NAME + "_discharge.csv"
     F_BASAL = CSV_OUT + EXP_NAME + "_basal.csv"
 
-    DISCHARGE.to_csv(F_DISCHARGE, mode="a", header=not os.path.exists(F_DISCHARGE))
-    BASAL.to_csv(F_BASAL, mode="a", header=not os.path.exists(F_BASAL))
+    append_csv(DISCHARGE, F_DISCHARGE)
+    append_csv(BASAL, F_BASAL)
     #DISCHARGE.to_csv(CSV_OUT + "discharge.csv", index=False)
     #BASAL.to_csv(CSV_OUT + "basal.csv", index=False)
     print(DISCHARGE, BASAL) # Test here instead
+    Monitoring(
+        MONITORING_OUT,
+        EXP_NAME,
+        name="freshwater",
+        baseline_file=FRESHWATER_BASELINE_FILE,
+    ).update(LEG_YEAR, freshwater=DISCHARGE + BASAL)
 
     FWF_FILE = FRESHWATER.calculate_nemo_forcing(
         DISCHARGE, BASAL, AREA_FILE, BM_MASK_FILE, CALVING_MASK_FILE, THETAO_FILE
@@ -1,16 +1,527 @@
 """This module is for methods and calculations related to
 the BISICLES filetools.
 
-classes: Flatten, Masks
+classes: ChomboFile, FlattenCache, Flatten, RegionLabels, LabelPyramid,
+Masks
+functions: atomic_write
 """
 
+import hashlib
+import json
 import os
 import subprocess
+import threading
+import time
+from contextlib import contextmanager
 from glob import glob
 import numpy as np
 import pandas as pd
 import xarray as xr
 
+try:
+    import h5py
+except ImportError:  # fall back on the flatten2d driver
+    h5py = None
+
+# Lower left corner of the BISICLES domain passed to flatten2d
+ORIGIN = (-3333500, -3333500)
+# Length of the sides of the square BISICLES domain in m
+DOMAIN_SIZE = 6144e3
+
+# Chombo hdf5 compound types for boxes and integer vectors
+BOX_DTYPE = np.dtype(
+    [("lo_i", "<i4"), ("lo_j", "<i4"), ("hi_i", "<i4"), ("hi_j", "<i4")]
+)
+INTVECT_DTYPE = np.dtype([("intvecti", "<i4"), ("intvectj", "<i4")])
+
+
+@contextmanager
+def atomic_write(file, mode="w"):
+    """Write a file through a temporary file next to it, which replaces the
+    file once it is written, so readers never see a partly written file
+    Args:
+        file (str): name of file
+        mode (str): open mode of the temporary file, None to yield its name
+        for writers that open the file themselves
+    Yields:
+        handle of the temporary file, or its name when mode is None
+    """
+    tmp_file = file + ".tmp"
+    if mode is None:
+        yield tmp_file
+    else:
+        with open(tmp_file, mode) as handle:
+            yield handle
+    os.replace(tmp_file, file)
+
+
+class ChomboFile:
+    """Class for reading BISICLES Chombo amr files directly with h5py
+    ...
+    Attributes
+    ----------
+    file (str): name of BISICLES amr file
+
+    Methods
+    -------
+    read_header
+        Read component names, number of levels and time
+    read_level
+        Read boxes and box data of one amr level
+    read_levels
+        Read all amr levels of the file
+    covered_masks
+        Mask the cells of each box that are covered by a finer level
+    flatten
+        Average the amr hierarchy onto a single level grid
+    region_sums
+        Integrate variables over regions straight from the amr hierarchy
+    write
+        Write fields to a single level amr file
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def read_header(self, h5):
+        """Read component names, number of levels and time
+        Args:
+            h5 (h5py file): open BISICLES amr file
+        Returns:
+            list of component names, number of levels (int) and time (float)
+        """
+        num_comps = int(h5.attrs["num_components"])
+        comps = []
+        for comp in range(num_comps):
+            name = h5.attrs["component_" + str(comp)]
+            if isinstance(name, bytes):
+                name = name.decode()
+            comps.append(str(name))
+        num_levels = int(h5.attrs["num_levels"])
+        plot_time = float(h5.attrs.get("time", 0.0))
+        assert num_levels > 0, "file contains no levels"
+        return comps, num_levels, plot_time
+
+    def read_level(self, h5, lev, num_comps, comp_index=None):
+        """Read boxes and box data of one amr level
+        Args:
+            h5 (h5py file): open BISICLES amr file
+            lev (int): amr level
+            num_comps (int): number of components in the file
+            comp_index (list): indices of the components to read, all if None
+        Returns:
+            dictionary with cell size, refinement ratio, problem domain,
+            box corners and a list of (component, y, x) box arrays
+        """
+        group = h5["level_" + str(lev)]
+        domain = group.attrs["prob_domain"]
+        boxes = group["boxes"][()]
+        lo = np.stack([boxes["lo_i"], boxes["lo_j"]], axis=1).astype(int)
+        hi = np.stack([boxes["hi_i"], boxes["hi_j"]], axis=1).astype(int)
+        ghost = np.zeros(2, dtype=int)
+        if "data_attributes" in group:
+            output_ghost = group["data_attributes"].attrs.get("outputGhost")
+            if output_ghost is not None:
+                ghost = np.array([output_ghost["intvecti"], output_ghost["intvectj"]])
+        offsets = group["data:offsets=0"][()]
+        if comp_index is None:
+            flat = group["data:datatype=0"][()]
+        else:
+            flat = group["data:datatype=0"]
+        data = []
+        for k in range(len(boxes)):
+            nx, ny = hi[k] - lo[k] + 1 + 2 * ghost
+            if comp_index is None:
+                box = flat[offsets[k] : offsets[k + 1]].reshape(num_comps, ny, nx)
+            else:
+                # Only read the hyperslab of each requested component
+                box = np.stack(
+                    [
+                        flat[
+                            offsets[k]
+                            + comp * nx * ny : offsets[k]
+                            + (comp + 1) * nx * ny
+                        ]
+                        for comp in comp_index
+                    ]
+                ).reshape(len(comp_index), ny, nx)
+            data.append(box[:, ghost[1] : ny - ghost[1], ghost[0] : nx - ghost[0]])
+        level = {
+            "dx": float(group.attrs["dx"]),
+            "ref_ratio": int(group.attrs.get("ref_ratio", 1)),
+            "domain_lo": np.array([domain["lo_i"], domain["lo_j"]], dtype=int),
+            "domain_hi": np.array([domain["hi_i"], domain["hi_j"]], dtype=int),
+            "lo": lo,
+            "hi": hi,
+            "data": data,
+        }
+        return level
+
+    def read_levels(self, variables=None):
+        """Read all amr levels of the file
+        Args:
+            variables (list): names of variables to read, all if None
+        Returns:
+            list of component names, list of amr levels and time (float)
+        """
+        with h5py.File(self.file, "r") as h5:
+            comps, num_levels, plot_time = self.read_header(h5)
+            comp_index = None
+            if variables is not None:
+                missing = [name for name in variables if name not in comps]
+                assert len(missing) == 0, "variables not in file: " + str(missing)
+                comp_index = [comps.index(name) for name in variables]
+            levels = [
+                self.read_level(h5, lev, len(comps), comp_index)
+                for lev in range(num_levels)
+            ]
+        if variables is not None:
+            comps = list(variables)
+        return comps, levels, plot_time
+
+    def covered_masks(self, level, finer):
+        """Mask the cells of each box that are covered by a finer level
+        Args:
+            level (dict): amr level as returned by read_level
+            finer (dict): next finer amr level, or None on the finest level
+        Returns:
+            list of boolean (y, x) arrays, True where a cell is covered
+        """
+        masks = []
+        if finer is not None:
+            ratio = level["ref_ratio"]
+            fine_lo = finer["lo"] // ratio
+            fine_hi = finer["hi"] // ratio
+        for lo, hi in zip(level["lo"], level["hi"]):
+            mask = np.zeros((hi[1] - lo[1] + 1, hi[0] - lo[0] + 1), dtype=bool)
+            if finer is not None:
+                ilo = np.maximum(fine_lo, lo)
+                ihi = np.minimum(fine_hi, hi)
+                overlap = np.all(ilo <= ihi, axis=1)
+                for b_lo, b_hi in zip(ilo[overlap] - lo, ihi[overlap] - lo):
+                    mask[b_lo[1] : b_hi[1] + 1, b_lo[0] : b_hi[0] + 1] = True
+            masks.append(mask)
+        return masks
+
+    def flatten(self, level=0, origin=ORIGIN, variables=None):
+        """Average the amr hierarchy onto a single level grid, like flatten2d
+        Args:
+            level (int): amr level of the output grid
+            origin (tuple): x and y coordinate of the lower left domain corner
+            variables (list): names of variables to read, all if None
+        Returns:
+            xarray dataset of flattened BISICLES file
+        """
+        comps, levels, plot_time = self.read_levels(variables)
+        num_levels = len(levels)
+        assert level < num_levels, "flatten level is not in file"
+        target = levels[level]
+        dom_lo = target["domain_lo"]
+        nx, ny = target["domain_hi"] - dom_lo + 1
+        flat = np.zeros((len(comps), ny, nx))
+        for lev, amr_level in enumerate(levels):
+            finer = levels[lev + 1] if lev + 1 < num_levels else None
+            covered = self.covered_masks(amr_level, finer)
+            # Fine cells are averaged onto the target grid, coarse cells are
+            # copied onto every target cell they contain
+            scale = target["dx"] / amr_level["dx"]
+            ratio = int(round(max(scale, 1.0 / scale)))
+            for lo, box, mask in zip(amr_level["lo"], amr_level["data"], covered):
+                valid = ~mask
+                if scale >= 1:
+                    t_i = (lo[0] + np.arange(box.shape[2])) // ratio - dom_lo[0]
+                    t_j = (lo[1] + np.arange(box.shape[1])) // ratio - dom_lo[1]
+                    t_i0, t_j0 = t_i[0], t_j[0]
+                    local_nx = t_i[-1] - t_i0 + 1
+                    local_ny = t_j[-1] - t_j0 + 1
+                    index = ((t_j - t_j0)[:, None] * local_nx + (t_i - t_i0)[None, :])[
+                        valid
+                    ]
+                    for comp in range(len(comps)):
+                        local_sum = np.bincount(
+                            index,
+                            weights=box[comp][valid],
+                            minlength=local_nx * local_ny,
+                        )
+                        flat[comp, t_j0 : t_j0 + local_ny, t_i0 : t_i0 + local_nx] += (
+                            local_sum.reshape(local_ny, local_nx) / ratio**2
+                        )
+                else:
+                    t_i0 = lo[0] * ratio - dom_lo[0]
+                    t_j0 = lo[1] * ratio - dom_lo[1]
+                    fine_valid = np.repeat(np.repeat(valid, ratio, 0), ratio, 1)
+                    fine_box = np.repeat(np.repeat(box, ratio, 1), ratio, 2)
+                    fine_ny, fine_nx = fine_valid.shape
+                    flat[:, t_j0 : t_j0 + fine_ny, t_i0 : t_i0 + fine_nx] += np.where(
+                        fine_valid, fine_box, 0.0
+                    )
+        x = origin[0] + (dom_lo[0] + np.arange(nx) + 0.5) * target["dx"]
+        y = origin[1] + (dom_lo[1] + np.arange(ny) + 0.5) * target["dx"]
+        dat = xr.Dataset(
+            {name: (("y", "x"), flat[comp]) for comp, name in enumerate(comps)},
+            coords={"x": x, "y": y, "time": plot_time},
+        )
+        return dat
+
+    def region_sums(self, labels, variables=None):
+        """Integrate variables over regions straight from the amr hierarchy,
+        using only the cells of each level that are not covered by a finer level
+        Args:
+            labels (RegionLabels): region id raster covering the amr domain
+            variables (list): names of variables to integrate, all if None
+        Returns:
+            pandas dataframe of the sum of each variable (columns) for each
+            region (index), in units of value times level 0 cell area
+        """
+        variables, levels, _ = self.read_levels(variables)
+        ids = list(labels.names)
+        names = [labels.names[key] for key in ids]
+        mask_dx = abs(float(labels.x[1] - labels.x[0]))
+        sums = np.zeros((len(names), len(variables)))
+        base_dx = levels[0]["dx"]
+        base_ny = levels[0]["domain_hi"][1] - levels[0]["domain_lo"][1] + 1
+        assert (
+            labels.labels.shape[0] * mask_dx == base_ny * base_dx
+        ), "labels do not cover the amr domain"
+        for lev, amr_level in enumerate(levels):
+            finer = levels[lev + 1] if lev + 1 < len(levels) else None
+            covered = self.covered_masks(amr_level, finer)
+            dx = amr_level["dx"]
+            # Weight of each valid cell relative to a level 0 cell
+            cell_area = (dx / base_dx) ** 2
+            for lo, hi, box, mask in zip(
+                amr_level["lo"], amr_level["hi"], amr_level["data"], covered
+            ):
+                ny, nx = mask.shape
+                values = np.nan_to_num(box)
+                values = np.where(mask, 0.0, values) * cell_area
+                if dx >= mask_dx:
+                    ratio = int(round(dx / mask_dx))
+                    window = labels.labels[
+                        lo[1] * ratio : (hi[1] + 1) * ratio,
+                        lo[0] * ratio : (hi[0] + 1) * ratio,
+                    ]
+                else:
+                    ratio = int(round(mask_dx / dx))
+                    window = labels.labels[
+                        lo[1] // ratio : hi[1] // ratio + 1,
+                        lo[0] // ratio : hi[0] // ratio + 1,
+                    ]
+                    window = np.repeat(np.repeat(window, ratio, 0), ratio, 1)
+                    window = window[
+                        lo[1] % ratio : lo[1] % ratio + ny,
+                        lo[0] % ratio : lo[0] % ratio + nx,
+                    ]
+                for reg, key in enumerate(ids):
+                    fraction = window == key
+                    if dx > mask_dx:
+                        # Fraction of each amr cell inside the region
+                        fraction = fraction.reshape(ny, ratio, nx, ratio).mean(
+                            axis=(1, 3)
+                        )
+                    sums[reg] += (values * fraction).sum(axis=(1, 2))
+        sums_df = pd.DataFrame(sums, index=names, columns=variables)
+        assert sums_df.empty is False, "Dataframe is empty"
+        return sums_df
+
+    def write(self, fields, dx, time=0.0, max_box_size=256):
+        """Write fields to a single level amr file, like nctoamr2d
+        Args:
+            fields (dict): component name and (y, x) np.array of each field
+            dx (float): cell size in m
+            time (float): time written to the file
+            max_box_size (int): maximum box length in cells
+        Returns:
+            Chombo hdf5 file that BISICLES can read as LevelData
+        """
+        comps = list(fields)
+        data = np.stack([np.asarray(fields[name], dtype=np.float64) for name in comps])
+        assert data.ndim == 3, "fields should be 2D arrays"
+        ny, nx = data.shape[1:]
+        boxes = []
+        chunks = []
+        offsets = [0]
+        for j_lo in range(0, ny, max_box_size):
+            for i_lo in range(0, nx, max_box_size):
+                j_hi = min(j_lo + max_box_size, ny) - 1
+                i_hi = min(i_lo + max_box_size, nx) - 1
+                boxes.append((i_lo, j_lo, i_hi, j_hi))
+                chunk = data[:, j_lo : j_hi + 1, i_lo : i_hi + 1].ravel()
+                chunks.append(chunk)
+                offsets.append(offsets[-1] + chunk.size)
+        with h5py.File(self.file, "w") as h5:
+            h5.attrs["time"] = float(time)
+            h5.attrs["iteration"] = np.int32(0)
+            h5.attrs["max_level"] = np.int32(0)
+            h5.attrs["num_levels"] = np.int32(1)
+            h5.attrs["num_components"] = np.int32(len(comps))
+            for comp, name in enumerate(comps):
+                h5.attrs["component_" + str(comp)] = np.bytes_(name)
+            chombo_global = h5.create_group("Chombo_global")
+            chombo_global.attrs["SpaceDim"] = np.int32(2)
+            chombo_global.attrs["testReal"] = 0.0
+            group = h5.create_group("level_0")
+            group.attrs["dx"] = float(dx)
+            group.attrs["dt"] = 1.0
+            group.attrs["time"] = float(time)
+            group.attrs["ref_ratio"] = np.int32(2)
+            group.attrs["prob_domain"] = np.array(
+                (0, 0, nx - 1, ny - 1), dtype=BOX_DTYPE
+            )
+            data_attributes = group.create_group("data_attributes")
+            data_attributes.attrs["comps"] = np.int32(len(comps))
+            data_attributes.attrs["objectType"] = np.bytes_("FArray")
+            data_attributes.attrs["ghost"] = np.array((0, 0), dtype=INTVECT_DTYPE)
+            data_attributes.attrs["outputGhost"] = np.array((0, 0), dtype=INTVECT_DTYPE)
+            group.create_dataset("boxes", data=np.array(boxes, dtype=BOX_DTYPE))
+            group.create_dataset(
+                "Processors", data=np.zeros(len(boxes), dtype=np.int32)
+            )
+            group.create_dataset(
+                "data:offsets=0", data=np.array(offsets, dtype=np.int64)
+            )
+            group.create_dataset("data:datatype=0", data=np.concatenate(chunks))
+
+
+class FlattenCache:
+    """Class for an on-disk cache of flattened BISICLES plot files
+    ...
+    Attributes
+    ----------
+    path (str): cache directory
+    max_bytes (int): maximum total size of the cached files
+
+    Methods
+    -------
+    file_hash
+        Hash the content of a file
+    key
+        Cache key of a plot file flattened at a level and origin
+    load_index
+        Read the cache index
+    save_index
+        Write the cache index
+    get
+        Open a cached flattened file
+    put
+        Add a flattened file to the cache
+    evict
+        Remove least recently used files until the cache fits its size cap
+    """
+
+    index_name = "flatten_cache.json"
+    chunk_size = 4 * 1024**2
+
+    def __init__(self, path, max_bytes=1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def file_hash(self, file):
+        """Hash the content of a file
+        Args:
+            file (str): name of file
+        Returns:
+            hex digest (str) of the file content
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        with open(file, "rb") as handle:
+            for chunk in iter(lambda: handle.read(self.chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def key(self, file, level, origin, variables=None):
+        """Cache key of a plot file flattened at a level and origin
+        Args:
+            file (str): name of BISICLES amr file
+            level (int): flatten level
+            origin (tuple): x and y coordinate of the lower left domain corner
+            variables (list): names of flattened variables, all if None
+        Returns:
+            cache key (str)
+        """
+        stat = os.stat(file)
+        key = {
+            "file": os.path.abspath(file),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "content": self.file_hash(file),
+            "level": int(level),
+            "origin": [float(origin[0]), float(origin[1])],
+            "variables": None if variables is None else sorted(variables),
+        }
+        return hashlib.blake2b(
+            json.dumps(key, sort_keys=True).encode(), digest_size=16
+        ).hexdigest()
+
+    def load_index(self):
+        """Read the cache index
+        Returns:
+            dictionary of cache key and size and last use of cached file
+        """
+        index_file = os.path.join(self.path, self.index_name)
+        if not os.path.exists(index_file):
+            return {}
+        with open(index_file) as handle:
+            return json.load(handle)
+
+    def save_index(self, index):
+        """Write the cache index
+        Args:
+            index (dict): cache index
+        """
+        index_file = os.path.join(self.path, self.index_name)
+        with atomic_write(index_file) as handle:
+            json.dump(index, handle)
+
+    def get(self, key):
+        """Open a cached flattened file
+        Args:
+            key (str): cache key
+        Returns:
+            xarray dataset of flattened BISICLES file, None if not cached
+        """
+        nc_name = os.path.join(self.path, key + ".nc")
+        with self.lock:
+            index = self.load_index()
+            if key not in index or not os.path.exists(nc_name):
+                return None
+            index[key]["last_used"] = time.time()
+            self.save_index(index)
+            with xr.open_dataset(nc_name) as dat:
+                return dat.load()
+
+    def put(self, key, dat):
+        """Add a flattened file to the cache
+        Args:
+            key (str): cache key
+            dat (xarray dataset): flattened BISICLES file
+        """
+        nc_name = os.path.join(self.path, key + ".nc")
+        with self.lock:
+            with atomic_write(nc_name, None) as tmp_file:
+                dat.to_netcdf(tmp_file, format="NETCDF4")
+            index = self.load_index()
+            index[key] = {"bytes": os.path.getsize(nc_name), "last_used": time.time()}
+            self.evict(index)
+            self.save_index(index)
+
+    def evict(self, index):
+        """Remove least recently used files until the cache fits its size cap
+        Args:
+            index (dict): cache index, updated in place
+        """
+        total = sum(entry["bytes"] for entry in index.values())
+        for key in sorted(index, key=lambda key: index[key]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            nc_name = os.path.join(self.path, key + ".nc")
+            if os.path.exists(nc_name):
+                os.remove(nc_name)
+            total -= index.pop(key)["bytes"]
+
 
 class Flatten:
     """Class for BISICLES amr files and methods relating to flatten
@@ -25,8 +536,12 @@ class Flatten:
         find base name of file
     flatten
         flatten amr file to netcdf
+    open_flattened
+        flatten amr file with flatten2d and open dataset
     open
-        flatten amr file and open dataset
+        read amr file natively, or flatten it with flatten2d, and open dataset
+    flatten_stats
+        Take sum, mean, min, max and count of each variable in flattened file
     flattenMean
         Take mean of each variable in flattened file
     flattenSum
@@ -37,6 +552,17 @@ class Flatten:
         Flatten amr file and take sum
     """
 
+    stats_dtype = np.dtype(
+        [
+            ("variable", "U64"),
+            ("sum", "f8"),
+            ("mean", "f8"),
+            ("min", "f8"),
+            ("max", "f8"),
+            ("count", "i8"),
+        ]
+    )
+
     def __init__(self, file):
         self.file = file
 
@@ -49,73 +575,151 @@ class Flatten:
         assert len(name) > 0, "name is empty"
         return name
 
-    def flatten(self, flatten, path):
+    def flatten(self, flatten, path, timeout=None):
         """Flatten AMR file to netcdf
         Args:
             flatten (str): path to flatten driver
             path (str): path to netcdf output
+            timeout (float): seconds to wait for flatten driver, no limit if None
         Returns:
             netcdf of flattend AMR file
         """
         name = self.find_name()
         nc_name = path + name + ".nc"
         flatten_output = subprocess.Popen(
-            [flatten, self.file, nc_name, "0", "-3333500", "-3333500"],
+            [flatten, self.file, nc_name, "0", str(ORIGIN[0]), str(ORIGIN[1])],
             stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
         )
-        # assess
-        flatten_output.communicate()[0]
+        try:
+            _, stderr = flatten_output.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            flatten_output.kill()
+            flatten_output.communicate()
+            raise RuntimeError(
+                "flatten2d timed out after " + str(timeout) + " s on " + self.file
+            )
+        if flatten_output.returncode != 0:
+            raise RuntimeError(
+                "flatten2d failed on "
+                + self.file
+                + " with exit code "
+                + str(flatten_output.returncode)
+                + ": "
+                + stderr.decode(errors="replace").strip()
+            )
 
-    def open(self, flatten, path):
-        """Flatten AMR file and open it
+    def open_flattened(self, flatten, path, timeout=None):
+        """Flatten AMR file with flatten2d and open it
         Args:
             flatten (str): path to flatten driver
             path (str): path to netcdf output
+            timeout (float): seconds to wait for flatten driver, no limit if None
         Returns:
             xarray dataset of flattened BISICLES file
         """
-        self.flatten(flatten, path)
+        self.flatten(flatten, path, timeout)
         name = self.find_name()
         nc_name = path + name + ".nc"
         dat = xr.open_dataset(nc_name)
         assert dat.time.size != 0, "dataset is empty"
         return dat
 
-    def flatten_mean(self, flatten_dat):
+    def open(self, flatten, path, cache=None, timeout=None, variables=None):
+        """Read AMR file into a level 0 dataset, using flatten2d when the
+        file cannot be read natively
+        Args:
+            flatten (str): path to flatten driver
+            path (str): path to netcdf output of flatten driver
+            cache (FlattenCache): cache of flattened files, optional
+            timeout (float): seconds to wait for flatten driver, no limit if None
+            variables (list): names of variables to read, all if None
+        Returns:
+            xarray dataset of flattened BISICLES file
+        """
+        if cache is not None:
+            key = cache.key(self.file, 0, ORIGIN, variables)
+            dat = cache.get(key)
+            if dat is not None:
+                return dat
+        dat = None
+        if h5py is not None:
+            try:
+                dat = ChomboFile(self.file).flatten(0, ORIGIN, variables)
+            except (OSError, KeyError) as err:
+                print("Native read of", self.file, "failed:", err)
+        if dat is None:
+            with self.open_flattened(flatten, path, timeout) as flat_dat:
+                if variables is not None:
+                    flat_dat = flat_dat[variables]
+                dat = flat_dat.load()
+            if cache is not None:
+                # The cache keeps its own copy of the flattened file
+                os.remove(path + self.find_name() + ".nc")
+        assert dat.time.size != 0, "dataset is empty"
+        if cache is not None:
+            cache.put(key, dat)
+        return dat
+
+    def flatten_stats(self, flatten_dat, variables=None, chunk_size=256, dim="y"):
+        """Take sum, mean, min, max and count of non-NaN values of each
+        variable in flattened file, in one pass over chunks of rows
+        Args:
+            flatten_dat (xarray dataset): BISICLES flattened file
+            variables (list): names of variables, all variables if None
+            chunk_size (int): number of rows along dim read at a time
+            dim (str): dimension to chunk over
+        Returns:
+            numpy structured array with one record of statistics per variable
+        """
+        if variables is None:
+            variables = list(flatten_dat.data_vars)
+        stats = np.zeros(len(variables), dtype=self.stats_dtype)
+        stats["variable"] = variables
+        stats["min"] = np.inf
+        stats["max"] = -np.inf
+        size = flatten_dat.sizes.get(dim, 1)
+        for start in range(0, size, chunk_size):
+            chunk = flatten_dat[variables]
+            if dim in flatten_dat.sizes:
+                chunk = chunk.isel({dim: slice(start, start + chunk_size)})
+            for k, name in enumerate(variables):
+                values = np.asarray(chunk[name].values, dtype=np.float64)
+                valid = ~np.isnan(values)
+                stats["sum"][k] += np.sum(values, where=valid)
+                stats["min"][k] = np.min(values, where=valid, initial=stats["min"][k])
+                stats["max"][k] = np.max(values, where=valid, initial=stats["max"][k])
+                stats["count"][k] += np.count_nonzero(valid)
+        empty = stats["count"] == 0
+        stats["mean"] = stats["sum"] / np.where(empty, 1, stats["count"])
+        for field in ["mean", "min", "max"]:
+            stats[field][empty] = np.nan
+        assert stats.size != 0, "No variables to reduce"
+        return stats
+
+    def flatten_mean(self, flatten_dat, variables=None):
         """Take mean of each variable in flattened file
         Args:
             flatten_dat (xarray dataset): BISICLES flattened file
+            variables (list): names of variables, all variables if None
         Returns:
             pandas dataframe (df) of mean values for each variable
         """
-        variables = []
-        means = []
-        for i in flatten_dat:
-            val_mean = flatten_dat[i].mean().values
-            variables.append(i)
-            means.append(val_mean)
-        means_df = pd.DataFrame(columns=vars)
-        series = pd.Series(means, index=means_df.columns)
-        means_df = means_df.append(series, ignore_index=True)
+        stats = self.flatten_stats(flatten_dat, variables)
+        means_df = pd.DataFrame([stats["mean"]], columns=list(stats["variable"]))
         assert means_df.empty is False, "Dataframe should not be empty"
         return means_df
 
-    def flatten_sum(self, flatten_dat):
+    def flatten_sum(self, flatten_dat, variables=None):
         """Take sum of each variable in flattened file
         Args:
             flatten_dat (xarray dataarray): BISICLES flattened file
+            variables (list): names of variables, all variables if None
         Returns:
             pandas dataframe (df) of sum of values for each variable
         """
-        variables = []
-        means = []
-        for i in flatten_dat:
-            val_sum = flatten_dat[i].sum().values
-            variables.append(i)
-            means.append(val_sum)
-        sums_df = pd.DataFrame(columns=vars)
-        series = pd.Series(means, index=sums_df.columns)
-        sums_df = sums_df.append(series, ignore_index=True)
+        stats = self.flatten_stats(flatten_dat, variables)
+        sums_df = pd.DataFrame([stats["sum"]], columns=list(stats["variable"]))
         assert sums_df.empty is False, "Dataframe should not be empty"
         return sums_df
 
@@ -142,37 +746,364 @@ class Flatten:
         return sums_df
 
 
+class RegionLabels:
+    """Class for a raster of region ids on the BISICLES mask grid
+    ...
+    Attributes
+    ----------
+    labels (np.array): int8 (y, x) region id of each cell, 0 outside all regions
+    names (dict): region id and region name
+    x, y (np.array): co-ordinates of the raster
+
+    Methods
+    -------
+    region_id
+        Find the id of a region
+    mask
+        Boolean mask of one region
+    masks
+        Dictionary of boolean masks of all regions
+    coarsen
+        Coarsen the raster by a whole factor with a block majority
+    save
+        Save labels to an npz file
+    """
+
+    def __init__(self, labels, names, x, y):
+        self.labels = labels
+        self.names = names
+        self.x = x
+        self.y = y
+
+    def region_id(self, name):
+        """Find the id of a region
+        Args:
+            name (str): region name
+        Returns:
+            region id (int)
+        """
+        ids = [key for key, value in self.names.items() if value == name]
+        assert len(ids) == 1, "region " + name + " not found"
+        return ids[0]
+
+    def mask(self, name):
+        """Boolean mask of one region
+        Args:
+            name (str): region name
+        Returns:
+            boolean (y, x) np.array, True inside the region
+        """
+        return self.labels == self.region_id(name)
+
+    def masks(self):
+        """Dictionary of boolean masks of all regions
+        Returns:
+            dictionary of region name and boolean (y, x) np.array
+        """
+        return {name: self.labels == key for key, name in self.names.items()}
+
+    def coarsen(self, factor, block_rows=512):
+        """Coarsen the raster by a whole factor, giving each coarse cell the
+        most common region id among the fine cells it contains
+        Args:
+            factor (int): coarsening factor
+            block_rows (int): number of fine rows counted at a time
+        Returns:
+            RegionLabels on the coarse grid
+        """
+        ny, nx = self.labels.shape
+        assert ny % factor == 0 and nx % factor == 0, "factor does not divide grid"
+        if factor == 1:
+            return self
+        assert factor * factor <= np.iinfo(np.int16).max, "factor too large"
+        num_ids = int(self.labels.max()) + 1
+        labels = np.zeros((ny // factor, nx // factor), dtype=np.int8)
+        best = np.zeros((ny // factor, nx // factor), dtype=np.int16)
+        # Count one id at a time over blocks of rows, the lowest id wins ties
+        block_rows = max(1, block_rows // factor)
+        for start in range(0, ny // factor, block_rows):
+            rows = slice(start, start + block_rows)
+            fine = self.labels[start * factor : (start + block_rows) * factor]
+            for key in range(num_ids):
+                counts = (
+                    (fine == key)
+                    .reshape(-1, factor, nx // factor, factor)
+                    .sum(axis=(1, 3), dtype=np.int16)
+                )
+                more = counts > best[rows]
+                best[rows][more] = counts[more]
+                labels[rows][more] = key
+        x = self.x.reshape(-1, factor).mean(axis=1)
+        y = self.y.reshape(-1, factor).mean(axis=1)
+        return RegionLabels(labels, dict(self.names), x, y)
+
+    def save(self, file, signature=""):
+        """Save labels to an npz file
+        Args:
+            file (str): name of npz file
+            signature (str): signature of the files the labels were built from
+        """
+        ids = np.array(list(self.names), dtype=np.int8)
+        names = np.array([self.names[key] for key in ids])
+        with atomic_write(file, "wb") as handle:
+            np.savez_compressed(
+                handle,
+                labels=self.labels,
+                ids=ids,
+                names=names,
+                x=self.x,
+                y=self.y,
+                signature=np.array(signature),
+            )
+
+
+class LabelPyramid:
+    """Class for region labels precomputed at several resolutions
+    ...
+    Attributes
+    ----------
+    levels (list): RegionLabels from the finest to the coarsest grid
+    version (int): version of the cache file layout
+
+    Methods
+    -------
+    select
+        Select the region labels matching a grid shape
+    save
+        Save all levels to an npz file
+    """
+
+    version = 1
+
+    def __init__(self, levels):
+        self.levels = levels
+
+    def select(self, shape):
+        """Select the region labels matching a grid shape
+        Args:
+            shape (tuple): (y, x) shape of the grid
+        Returns:
+            RegionLabels on the grid
+        """
+        for labels in self.levels:
+            if labels.labels.shape == tuple(shape):
+                return labels
+        raise ValueError("No region labels for grid shape " + str(tuple(shape)))
+
+    def save(self, file, signature=""):
+        """Save all levels to an npz file
+        Args:
+            file (str): name of npz file
+            signature (str): signature of the files the labels were built from
+        """
+        names = self.levels[0].names
+        ids = np.array(list(names), dtype=np.int8)
+        arrays = {
+            "version": np.array(self.version),
+            "signature": np.array(signature),
+            "ids": ids,
+            "names": np.array([names[key] for key in ids]),
+        }
+        for lev, labels in enumerate(self.levels):
+            arrays["labels_" + str(lev)] = labels.labels
+            arrays["x_" + str(lev)] = labels.x
+            arrays["y_" + str(lev)] = labels.y
+        with atomic_write(file, "wb") as handle:
+            np.savez_compressed(handle, **arrays)
+
+
 class Masks:
     """Class for opening bisicles amr masks
 
     Attributes
     ----------
     path (str): path to mask files
+    sectors (object): sector definitions with a bisicles_labels method, used
+    to derive the region labels when there are no mask files
 
     Methods
     -------
-    bisicles_masks
-        Method opening region masks and creating a dictionary containing them
+    mask_files
+        Find region mask files and their region names
+    from_sectors
+        Whether region labels are derived from sector coordinates
+    grid_coords
+        Co-ordinates of the cell centres of the mask grid
+    signature
+        Signature of the mask files
+    labels_from_files
+        Build the region label raster from the mask files
+    region_labels
+        Build or load the region label raster of the masks
+    label_pyramid
+        Build or load the region labels at several resolutions
 
     """
 
-    def __init__(self, path):
+    labels_file = "region_labels.npz"
+    pyramid_file = "region_pyramid.npz"
+    # Regions from lowest to highest precedence where masks overlap, as in
+    # the np.where chain the basal melt forcing was first mapped with.
+    # Regions not listed are written first, by name
+    region_priority = ("apen", "amun", "ross", "eais", "wedd")
+    # Coarsening factors of the 1 km masks: 1, 2, 4 and 8 km grids
+    pyramid_factors = (1, 2, 4, 8)
+    # Number of mask rows read from file at a time
+    block_rows = 512
+    # Cell size of the masks in m
+    grid_dx = 1000.0
+
+    def __init__(self, path, sectors=None):
         self.path = path
+        self.sectors = sectors
+
+    def mask_files(self):
+        """Find region mask files and their region names
+        Returns:
+            dictionary of region name and mask file, sorted by name
+        """
+        files = {}
+        for file in glob(os.path.join(self.path, "*.2d.nc")):
+            name = str(os.path.splitext(os.path.basename(file))[0][10:-5])
+            files[name] = file
+        assert len(files) != 0, "No mask files found"
+        return {name: files[name] for name in sorted(files)}
 
-    def bisicles_masks(self):
-        """Open region masks and create dictionary
+    def from_sectors(self):
+        """Whether region labels are derived from sector coordinates
         Returns:
-            x,y co-ordinate np.array and bisicles_mask (np.array) of each Antarctic region
+            True when sectors are given and there are no mask files
         """
-        nc_files = glob(os.path.join(self.path, "*.2d.nc"))
-        bisicles_masks = {}
-        for file in nc_files:
-            key = os.path.splitext(os.path.basename(file))[0][10:-5]
-            name = str(key)
-            dat = xr.open_dataset(file)
-            bisicles_masks[name] = np.array(dat["smask"])
-        assert len(bisicles_masks) != 0, "Dictionary should not be empty"
+        if self.sectors is None:
+            return False
+        return len(glob(os.path.join(self.path, "*.2d.nc"))) == 0
+
+    def grid_coords(self):
+        """Co-ordinates of the cell centres of the mask grid
+        Returns:
+            x,y co-ordinate np.array
+        """
+        size = int(round(DOMAIN_SIZE / self.grid_dx))
+        x = ORIGIN[0] + (np.arange(size) + 0.5) * self.grid_dx
+        y = ORIGIN[1] + (np.arange(size) + 0.5) * self.grid_dx
+        return x, y
+
+    def signature(self):
+        """Signature of the mask files, or of the grid and sector definitions
+        when the labels are derived from sector coordinates
+        Returns:
+            json string of the name, size and mtime of each mask file
+        """
+        if self.from_sectors():
+            x, y = self.grid_coords()
+            grid_hash = hashlib.blake2b(x.tobytes() + y.tobytes(), digest_size=16)
+            return json.dumps(
+                ["sectors", grid_hash.hexdigest(), self.sectors.signature()]
+            )
+        files = self.mask_files()
+        signature = json.dumps(
+            [
+                [name, os.path.getsize(file), os.stat(file).st_mtime_ns]
+                for name, file in files.items()
+            ]
+            + [list(self.region_priority)]
+        )
+        return signature
 
-        x = np.array(dat["x"])
-        y = np.array(dat["y"])
-        return x, y, bisicles_masks
+    def region_labels(self, cache_file=None):
+        """Build the region label raster of the masks, or load it from its
+        npz cache when the mask files (or grid and sectors) have not changed.
+        Cells in several masks get the id of the region of highest precedence
+        in region_priority.
+        Args:
+            cache_file (str): name of npz cache, region_labels.npz in the
+            mask path if None
+        Returns:
+            RegionLabels of the Antarctic regions
+        """
+        if cache_file is None:
+            cache_file = os.path.join(self.path, self.labels_file)
+        signature = self.signature()
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                if str(cached["signature"]) == signature:
+                    names = dict(zip(cached["ids"].tolist(), cached["names"].tolist()))
+                    return RegionLabels(
+                        cached["labels"], names, cached["x"], cached["y"]
+                    )
+        if self.from_sectors():
+            x, y = self.grid_coords()
+            region_labels = self.sectors.bisicles_labels(x, y)
+        else:
+            region_labels = self.labels_from_files()
+        if not os.path.exists(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        region_labels.save(cache_file, signature)
+        return region_labels
+
+    def labels_from_files(self):
+        """Build the region label raster from the mask files, reading them in
+        blocks of rows. Region ids follow the names, the masks are written in
+        region_priority order so later regions take the overlapping cells.
+        Returns:
+            RegionLabels of the Antarctic regions
+        """
+        files = self.mask_files()
+        region_ids = {name: key for key, name in enumerate(files, start=1)}
+        rank = {name: key for key, name in enumerate(self.region_priority, start=1)}
+        labels = None
+        names = {}
+        for name in sorted(files, key=lambda name: (rank.get(name, 0), name)):
+            region_id = region_ids[name]
+            with xr.open_dataset(files[name]) as dat:
+                if labels is None:
+                    labels = np.zeros(dat["smask"].shape, dtype=np.int8)
+                    x = np.array(dat["x"])
+                    y = np.array(dat["y"])
+                # Read the mask in blocks of rows to keep memory use low
+                for start in range(0, labels.shape[0], self.block_rows):
+                    rows = slice(start, start + self.block_rows)
+                    smask = np.array(dat["smask"][rows])
+                    labels[rows][smask == 1] = region_id
+            names[region_id] = name
+        names = {key: names[key] for key in sorted(names)}
+        region_labels = RegionLabels(labels, names, x, y)
+        return region_labels
+
+    def label_pyramid(self, factors=None, cache_file=None):
+        """Build the region labels at several resolutions by block majority
+        coarsening of the mask resolution labels, or load them from their
+        versioned npz cache
+        Args:
+            factors (tuple): coarsening factors, pyramid_factors if None
+            cache_file (str): name of npz cache, region_pyramid.npz in the
+            mask path if None
+        Returns:
+            LabelPyramid of the Antarctic regions
+        """
+        if factors is None:
+            factors = self.pyramid_factors
+        if cache_file is None:
+            cache_file = os.path.join(self.path, self.pyramid_file)
+        signature = json.dumps([self.signature(), list(factors)])
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                if (
+                    int(cached["version"]) == LabelPyramid.version
+                    and str(cached["signature"]) == signature
+                ):
+                    names = dict(zip(cached["ids"].tolist(), cached["names"].tolist()))
+                    levels = [
+                        RegionLabels(
+                            cached["labels_" + str(lev)],
+                            names,
+                            cached["x_" + str(lev)],
+                            cached["y_" + str(lev)],
+                        )
+                        for lev in range(len(factors))
+                    ]
+                    return LabelPyramid(levels)
+        base = self.region_labels()
+        pyramid = LabelPyramid([base.coarsen(factor) for factor in factors])
+        pyramid.save(cache_file, signature)
+        return pyramid
@@ -4,9 +4,13 @@ This module contains classes for different types of Antarctic Sectors
 Classes: LevermannSectors
 """
 
+import hashlib
+import json
 import os
 import numpy as np
 import xarray as xr
+from freshwater_coupling import amr_tools
+from freshwater_coupling.amr_tools import ChomboFile, RegionLabels, atomic_write
 from freshwater_coupling.amr_tools import Masks as bisi_masks
 
 
@@ -24,6 +28,7 @@ class LevermannSectors:
     sectors (list): list of region names (str)
     find_shelf_depth (dict): dictionary containing shelfbase depth for each region
     ds (xarray dataset): xarray dataset of ocean temperature
+    ice_boxes (dict): coordinates of the sectors on the ice sheet grid
 
     Methods
     -------
@@ -33,6 +38,24 @@ class LevermannSectors:
         create dictionary of masks
     sector_sel
         select a region
+    sector_raster
+        Build the int8 sector flag raster of the ocean grid
+    sector_labels
+        Build or load the sector flag raster of the ocean grid
+    sector_mask
+        Select the mask of one sector from the sector flag raster
+    signature
+        json string of the sector coordinates
+    polar_stereographic_latlon
+        Convert polar stereographic x,y co-ordinates to latitude and longitude
+    bisicles_labels
+        Classify the cells of the BISICLES grid into sectors
+    forcing_field
+        Gather region values onto the region id raster
+    forcing_inputs
+        Render the BISICLES inputs entries of a basal melt series
+    map2amr
+        Map basal melt values to the BISICLES grid and write an amr file
     """
 
     eais1 = [-76, -65, 0, 173]
@@ -43,6 +66,40 @@ class LevermannSectors:
     apen1 = [-70, -65, 294, 310]
     apen2 = [-75, -70, 285, 295]
 
+    # Name of the sector definitions, used in cache file names
+    name = "sectors"
+
+    # float32 buffer of the BISICLES forcing field, reused for the records of
+    # one map2amr call. Each leg runs in a new process, so it is not kept
+    # between legs
+    forcing_buffer = None
+
+    # Bit of each sector in the ocean grid sector flag raster
+    sector_ids = {"eais": 0, "wedd": 1, "amun": 2, "ross": 3, "apen": 4}
+
+    # The ocean boxes only cover the continental shelf, so the ice sheet is
+    # split into the same sectors extended to the pole and to 60S. The ice
+    # boxes do not overlap. Where the ocean boxes share longitudes the ice
+    # is split at the latitude the ocean boxes use: between 150E and 173E
+    # ross takes the ice south of 76S and eais the ice north of it, like
+    # the ross and eais ocean boxes. The peninsula is apen north of 75S
+    # (285E to 295E) and north of 70S (295E to 310E), as in the apen ocean
+    # boxes, the ice south of it goes to amun and wedd. The boxes are
+    # half-open, [lat1, lat2) x [lon1, lon2), and tile [-90, -60) x [0, 360).
+    ice_boxes = {
+        "eais": [[-90, -60, 0, 150], [-76, -60, 150, 173], [-90, -60, 350, 360]],
+        "wedd": [[-90, -70, 295, 310], [-90, -60, 310, 350]],
+        "amun": [[-90, -60, 210, 285], [-90, -75, 285, 295]],
+        "ross": [[-90, -76, 150, 173], [-90, -60, 173, 210]],
+        "apen": [[-75, -60, 285, 295], [-70, -60, 295, 310]],
+    }
+
+    # WGS84 ellipsoid and standard parallel of the Antarctic polar
+    # stereographic projection (EPSG:3031) of the BISICLES grid
+    semi_major_axis = 6378137.0
+    eccentricity = 0.0818191908426
+    true_scale_lat = -71.0
+
     def create_mask(self, thetao_ds, coords):
         """create a mask based on coordinates
         Args:
@@ -93,31 +150,236 @@ class LevermannSectors:
 
         return masks
 
-    def map2amr(self, mask_path, nc_out, driver, name, basalmelt_df):
-        """Map basal melt values to corresponding masks and create amr file
+    def sector_raster(self, area_ds):
+        """Build the int8 sector flag raster of the ocean grid
+        Args:
+            area_ds (xarray dataset): areacello dataset
+        Returns:
+            flags (np.array): int8 sector flags of each ocean cell
+        """
+        masks = self.sector_masks(area_ds)
+        flags = np.zeros(area_ds.coords["latitude"].shape, dtype=np.int8)
+        for sector, bit in self.sector_ids.items():
+            flags |= np.asarray(masks[sector], dtype=np.int8) << bit
+        return flags
+
+    def sector_labels(self, area_ds, cache_file):
+        """Build the int8 sector flag raster of the ocean grid, or load it
+        from its npz cache when the grid and sector boxes have not changed.
+        Bit sector_ids[sector] of a cell is set when the cell is in the
+        sector, so cells in overlapping boxes belong to both sectors.
+        Args:
+            area_ds (xarray dataset): areacello dataset
+            cache_file (str): name of npz cache
+        Returns:
+            flags (xarray dataarray): int8 sector flags of each ocean cell
+        """
+        lat = np.ascontiguousarray(area_ds.coords["latitude"].values)
+        lon = np.ascontiguousarray(area_ds.coords["longitude"].values)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(lat.tobytes())
+        digest.update(lon.tobytes())
+        digest.update(self.signature().encode())
+        signature = digest.hexdigest()
+        flags = None
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                if str(cached["signature"]) == signature:
+                    flags = cached["flags"]
+        if flags is None:
+            flags = self.sector_raster(area_ds)
+            with atomic_write(cache_file, "wb") as handle:
+                np.savez(handle, flags=flags, signature=np.array(signature))
+        dims = area_ds.coords["latitude"].dims
+        return xr.DataArray(flags, dims=dims, name="sector_flags")
+
+    def sector_mask(self, flags, sector):
+        """Select the mask of one sector from the sector flag raster
+        Args:
+            flags (xarray dataarray): sector flags from sector_labels
+            sector (str): sector name
+        Returns:
+            mask (xarray dataarray): boolean mask of sector
+        """
+        return (flags & (1 << self.sector_ids[sector])) != 0
+
+    def signature(self):
+        """json string of the sector coordinates
+        Returns:
+            json string of the ocean and ice sheet sector coordinates
+        """
+        boxes = {
+            "eais1": self.eais1,
+            "eais2": self.eais2,
+            "wedd": self.wedd,
+            "amun": self.amun,
+            "ross": self.ross,
+            "apen1": self.apen1,
+            "apen2": self.apen2,
+            "ice_boxes": self.ice_boxes,
+        }
+        return json.dumps(boxes, sort_keys=True)
+
+    def polar_stereographic_latlon(self, x, y):
+        """Convert Antarctic polar stereographic x,y co-ordinates to latitude
+        and longitude (Snyder 1987, ellipsoidal inverse)
+        Args:
+            x, y (np.array): co-ordinates in m
+        Returns:
+            latitude and longitude (np.array) in degrees, longitude in [0, 360)
+        """
+        ecc = self.eccentricity
+        lat_c = np.radians(-self.true_scale_lat)
+        m_c = np.cos(lat_c) / np.sqrt(1 - (ecc * np.sin(lat_c)) ** 2)
+        t_c = np.tan(np.pi / 4 - lat_c / 2) / (
+            ((1 - ecc * np.sin(lat_c)) / (1 + ecc * np.sin(lat_c))) ** (ecc / 2)
+        )
+        rho = np.hypot(x, y)
+        t = rho * t_c / (self.semi_major_axis * m_c)
+        chi = np.pi / 2 - 2 * np.arctan(t)
+        lat = (
+            chi
+            + (ecc**2 / 2 + 5 * ecc**4 / 24 + ecc**6 / 12 + 13 * ecc**8 / 360)
+            * np.sin(2 * chi)
+            + (7 * ecc**4 / 48 + 29 * ecc**6 / 240 + 811 * ecc**8 / 11520)
+            * np.sin(4 * chi)
+            + (7 * ecc**6 / 120 + 81 * ecc**8 / 1120) * np.sin(6 * chi)
+            + (4279 * ecc**8 / 161280) * np.sin(8 * chi)
+        )
+        lat = -np.degrees(lat)
+        lon = np.degrees(np.arctan2(x, y)) % 360
+        return lat, lon
+
+    def bisicles_labels(self, x, y, block_rows=512):
+        """Classify the cells of the BISICLES grid into sectors, projecting
+        one block of rows at a time
+        Args:
+            x, y (np.array): co-ordinates of the grid cell centres in m
+            block_rows (int): number of rows classified at a time
+        Returns:
+            RegionLabels of the sectors, with ids in sorted name order
+        """
+        names = {key: name for key, name in enumerate(sorted(self.ice_boxes), 1)}
+        ids = {name: key for key, name in names.items()}
+        labels = np.zeros((len(y), len(x)), dtype=np.int8)
+        for start in range(0, len(y), block_rows):
+            y_block = y[start : start + block_rows]
+            lat, lon = self.polar_stereographic_latlon(x[None, :], y_block[:, None])
+            lon = np.where(lon >= 360, lon - 360, lon)
+            block = labels[start : start + block_rows]
+            for name, boxes in self.ice_boxes.items():
+                for coords in boxes:
+                    # Half-open boxes, so boxes sharing an edge tile the grid
+                    inside = (
+                        (lat >= coords[0])
+                        & (lat < coords[1])
+                        & (lon >= coords[2])
+                        & (lon < coords[3])
+                    )
+                    block[inside] = ids[name]
+        return RegionLabels(labels, names, x, y)
+
+    def forcing_field(self, labels, values, fill_value=0.0):
+        """Gather the value of each region onto the region id raster, in
+        place in a float32 buffer reused between calls of the same process
+        Args:
+            labels (RegionLabels): region id raster
+            values (dict or pandas series): value of each region name
+            fill_value (float): value of cells outside all regions
+        Returns:
+            field (np.array): float32 (y, x) field
+        """
+        lookup = np.full(max(labels.names) + 1, fill_value, dtype=np.float32)
+        for key, name in labels.names.items():
+            lookup[key] = values[name]
+        if (
+            self.forcing_buffer is None
+            or self.forcing_buffer.shape != labels.labels.shape
+        ):
+            self.forcing_buffer = np.empty(labels.labels.shape, dtype=np.float32)
+        np.take(lookup, labels.labels, out=self.forcing_buffer)
+        return self.forcing_buffer
+
+    def forcing_inputs(self, file_format, num_records, time_step, start_time):
+        """Render the BISICLES inputs entries of a basal melt series
+        Args:
+            file_format (str): printf format of the record file names
+            num_records (int): number of records
+            time_step (float): time between records in years
+            start_time (float): time of the first record in years
+        Returns:
+            inputs (str): basalFlux.floating entries
+        """
+        inputs = (
+            "basalFlux.floating.n = %d\n" % num_records
+            + "basalFlux.floating.timeStep = %r\n" % float(time_step)
+            + "basalFlux.floating.startTime = %r\n" % float(start_time)
+            + "basalFlux.floating.fileFormat = %s\n" % file_format
+        )
+        return inputs
+
+    def map2amr(
+        self,
+        mask_path,
+        nc_out,
+        driver,
+        name,
+        basalmelt_df,
+        fill_value=0.0,
+        time_step=None,
+        start_time=0.0,
+    ):
+        """Map basal melt values to corresponding masks and create amr file.
+        By default only the last row of the dataframe is kept in
+        name.2d.hdf5. With a time_step every row is written as a numbered
+        record name.%06d.2d.hdf5, and the matching basalFlux.floating entries
+        are written to name.inputs to be appended to the BISICLES inputs file.
         Args:
             mask_path (str): path to mask files
-            nc_out (str): path to output netcdf
-            name (str): name of output netcdf
+            nc_out (str): path to output amr file
+            driver (str): path to nctoamr2d, used when h5py is not available
+            name (str): name of output amr file
             df (pandas dataframe): dataframe of basal melt values
+            fill_value (float): basal melt outside all regions
+            time_step (float): time between rows in years, None for a single
+            record
+            start_time (float): time of the first row in years
         Returns:
-            Netcdf and amr file with basal melt mapped for each Levermann region
+            amr file with basal melt mapped for each Levermann region
         """
 
-        x, y, bisicles_masks = bisi_masks(mask_path).bisicles_masks()
+        labels = bisi_masks(mask_path, self).region_labels()
+        x, y = labels.x, labels.y
+        inputs_file = nc_out + name + ".inputs"
+        if time_step is None:
+            file_format = nc_out + name + ".2d.hdf5"
+            if os.path.exists(inputs_file):
+                os.remove(inputs_file)
+        else:
+            file_format = nc_out + name + ".%06d.2d.hdf5"
 
-        for i, row in basalmelt_df.iterrows():
-            new_mask = np.where(
-                bisicles_masks["apen"] == 1, row.apen, bisicles_masks["apen"]
-            )
-            new_mask = np.where(bisicles_masks["amun"] == 1, row.amun, new_mask)
-            new_mask = np.where(bisicles_masks["ross"] == 1, row.ross, new_mask)
-            new_mask = np.where(bisicles_masks["eais"] == 1, row.eais, new_mask)
-            new_mask = np.where(bisicles_masks["wedd"] == 1, row.wedd, new_mask)
+        for record, (i, row) in enumerate(basalmelt_df.iterrows()):
+            new_mask = self.forcing_field(labels, row, fill_value)
+            if time_step is None:
+                amr_file, nc_file, time = file_format, nc_out + name + ".nc", 0.0
+            else:
+                amr_file = file_format % record
+                nc_file = nc_out + name + ".%06d.nc" % record
+                time = start_time + record * time_step
+            if amr_tools.h5py is not None:
+                ChomboFile(amr_file).write(
+                    {"bm": new_mask}, dx=abs(x[1] - x[0]), time=time
+                )
+                continue
             basal_da = xr.DataArray(
                 data=new_mask, coords=[("x", x), ("y", y)], name="bm"
             )
-            basal_da.to_netcdf(nc_out + name + ".nc")
-            os.system(
-                driver + " " + nc_out + name + ".nc " + nc_out + name + ".2d.hdf5 bm"
+            basal_da.to_netcdf(nc_file)
+            os.system(driver + " " + nc_file + " " + amr_file + " bm")
+
+        if time_step is not None:
+            inputs = self.forcing_inputs(
+                file_format, len(basalmelt_df), time_step, start_time
             )
+            with atomic_write(inputs_file) as handle:
+                handle.write(inputs)
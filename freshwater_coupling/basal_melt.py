@@ -4,9 +4,14 @@ ocean temperature from EC-Earth.
 Classes: OceanData, BasalMelt
 """
 
+import hashlib
+import os
+import warnings
 import numpy as np
 import xarray as xr
 import pandas as pd
+from scipy import sparse
+from freshwater_coupling.amr_tools import atomic_write
 from freshwater_coupling.antarctic_sectors import LevermannSectors as levermann
 
 
@@ -16,8 +21,10 @@ class OceanData:
 
     Attributes
     ----------
-    thetao (str): name of ocean temperature file
+    thetao (str or list of str): name of ocean temperature file, or names
+    of all ocean temperature files of the leg
     area (str): name of areacello file
+    sector_defs: sector definitions, LevermannSectors or PolygonSectors
 
     Methods
     -------
@@ -40,6 +47,38 @@ class OceanData:
         Compute mean of depth bounds
     select_area_mean
         Compute area mean of sector
+    sector_cache_file
+        Name of the cached sector flag raster of the ocean grid
+    layer_weights
+        Thickness of each ocean layer inside a depth range
+    profile_operator
+        Build the sparse sector layer area weight operator
+    weight_operator
+        Build the sparse sector volume weight operator
+    operator_cache_file
+        Name of the cached sector volume weight operator
+    sector_weights
+        Build or load the sector volume weight operator
+    hyperslab
+        Find the j and lev ranges covering all sectors and depth ranges
+    thetao_files
+        List the ocean temperature files
+    record_weights
+        Length of the time bounds of each record of a file
+    annual_mean
+        Time-weighted mean of a hyperslab of thetao over all records
+    sector_means
+        Apply the sector volume weight operator to one or more records
+    record_sector_means
+        Volume weighted mean temperature of each sector for every record
+    ocean_grid
+        Open the areacello dataset, the sector raster and the depth bands
+    depth_profiles
+        Area weighted temperature profile of each sector over all levels
+    depth_windows
+        Depth range of each sector
+    window_means
+        Depth weighted mean of sector profiles over any depth windows
     weighted_mean_df
         Compute volume weighted mean for one year of thetao
     """
@@ -50,9 +89,18 @@ class OceanData:
     # Sector-specific depths (based on shelf base depth)
     find_shelf_depth = {"eais": 369, "wedd": 420, "amun": 305, "ross": 312, "apen": 420}
 
-    def __init__(self, thetao, area):
+    # Number of thetao records read at a time by record_sector_means
+    record_chunk = 16
+
+    def __init__(self, thetao, area, sector_defs=None):
         self.thetao = thetao
         self.area = area
+        if sector_defs is None:
+            sector_defs = levermann()
+        else:
+            self.sectors = list(sector_defs.sector_ids)
+            self.find_shelf_depth = sector_defs.find_shelf_depth
+        self.sector_defs = sector_defs
 
     def open_datasets(self):
         """Open datasets
@@ -62,7 +110,7 @@ class OceanData:
         Returns:
             xarray datasets of ocean temperature and area dataset
         """
-        thetao_ds = xr.open_dataset(self.thetao)
+        thetao_ds = xr.open_dataset(self.thetao_files()[0])
         area_ds = xr.open_dataset(self.area)
         return thetao_ds, area_ds
 
@@ -141,7 +189,7 @@ class OceanData:
         levs_slice = thetao_ds.isel(lev=slice(lev_ind_top, lev_ind_bottom + 1))
         # Create weights for each oceanic layer, correcting for layers
         # that fall only partly within specified depth range
-        lev_bnds_sel = lev_bnds.values[lev_ind_top : lev_ind_bottom + 1]
+        lev_bnds_sel = lev_bnds.values[lev_ind_top : lev_ind_bottom + 1].copy()
         lev_bnds_sel[lev_bnds_sel > bottom] = bottom
         lev_bnds_sel[lev_bnds_sel < top] = top
         # Weight equals thickness of each layer
@@ -193,47 +241,394 @@ class OceanData:
         lev_weighted_mean = self.lev_weighted_mean(thetao_ds, lev_bnds, top, bottom)
         return lev_weighted_mean
 
-    def weighted_mean_df(self):
-        """Compute volume weighted mean for one year of thetao
+    def sector_cache_file(self):
+        """Name of the cached sector raster of the ocean grid
+        Returns:
+            npz file name (str) next to the area file
+        """
+        return os.path.splitext(self.area)[0] + "." + self.sector_defs.name + ".npz"
+
+    def layer_weights(self, lev_bnds, top, bottom):
+        """Thickness of each ocean layer inside a depth range, zero for
+        layers outside of it
+        Args:
+            lev_bnds (np.array): (lev, 2) ocean depth bands
+            top, bottom (float): depth range limits
+        Returns:
+            weights (np.array): layer weights
+        """
+        upper = np.maximum(lev_bnds[:, 0], top)
+        lower = np.minimum(lev_bnds[:, 1], bottom)
+        return np.maximum(lower - upper, 0.0)
+
+    def profile_operator(self, area, flags, valid):
+        """Build the sparse operator of shape (sector*lev) x (lev*j*i) that
+        gives the area weighted mean temperature of each layer of each
+        sector, over the cells of the sector with valid data. Rows of layers
+        without valid data are empty.
+        Args:
+            area (np.array): (j, i) cell areas, 0 where missing
+            flags (xarray dataarray): sector flags from sector_labels
+            valid (np.array): (lev, j, i) boolean mask of valid temperatures
+        Returns:
+            operator (scipy csr matrix): sector layer area weights
+        """
+        num_levs = valid.shape[0]
+        rows, cols, vals = [], [], []
+        for row, sector in enumerate(self.sectors):
+            mask = np.asarray(self.sector_defs.sector_mask(flags, sector))
+            cells = valid & mask & (area > 0)
+            area_sums = np.where(cells, area, 0.0).sum(axis=(1, 2))
+            lev_index, j_index, i_index = np.nonzero(cells)
+            rows.append(row * num_levs + lev_index)
+            cols.append(
+                np.ravel_multi_index((lev_index, j_index, i_index), valid.shape)
+            )
+            vals.append(area[j_index, i_index] / area_sums[lev_index])
+        rows, cols, vals = map(np.concatenate, (rows, cols, vals))
+        operator = sparse.csr_matrix(
+            (vals, (rows, cols)), shape=(len(self.sectors) * num_levs, valid.size)
+        )
+        return operator
+
+    def weight_operator(self, area, flags, lev_bnds, valid):
+        """Build the sparse operator of shape sectors x (lev*j*i) that gives
+        the volume weighted mean temperature of each sector. Row s combines
+        the area weighted mean of each layer, over the cells of the sector
+        with valid data, with the depth weighted mean over the layers of the
+        sector depth range that have valid data.
+        Args:
+            area (np.array): (j, i) cell areas, 0 where missing
+            flags (xarray dataarray): sector flags from sector_labels
+            lev_bnds (np.array): (lev, 2) ocean depth bands
+            valid (np.array): (lev, j, i) boolean mask of valid temperatures
+        Returns:
+            operator (scipy csr matrix): sector volume weights
+        """
+        profile = self.profile_operator(area, flags, valid)
+        num_sectors, num_levs = len(self.sectors), valid.shape[0]
+        has_data = np.diff(profile.indptr).reshape(num_sectors, num_levs) > 0
+        lev_weights = has_data * [
+            self.layer_weights(lev_bnds, *self.select_depth_range(sector))
+            for sector in self.sectors
+        ]
+        totals = lev_weights.sum(axis=1, keepdims=True)
+        lev_weights = np.divide(
+            lev_weights, totals, out=np.zeros_like(lev_weights), where=totals > 0
+        )
+        depth = sparse.csr_matrix(
+            (
+                lev_weights.ravel(),
+                (
+                    np.repeat(np.arange(num_sectors), num_levs),
+                    np.arange(num_sectors * num_levs),
+                ),
+            ),
+            shape=(num_sectors, num_sectors * num_levs),
+        )
+        depth.eliminate_zeros()
+        operator = (depth @ profile).tocsr()
+        operator.eliminate_zeros()
+        return operator
+
+    def operator_cache_file(self):
+        """Name of the cached sector volume weight operator
+        Returns:
+            npz file name (str) next to the area file
+        """
+        return (
+            os.path.splitext(self.area)[0]
+            + "."
+            + self.sector_defs.name
+            + ".weights.npz"
+        )
+
+    def sector_weights(self, area_ds, flags, lev_bnds, valid):
+        """Build the sector volume weight operator, or load it from its npz
+        cache when the grid, the sector definitions, the depth ranges and the
+        mask of valid temperatures have not changed
+        Args:
+            area_ds (xarray dataset): areacello dataset
+            flags (xarray dataarray): sector flags from sector_labels
+            lev_bnds (np.array): (lev, 2) ocean depth bands
+            valid (np.array): (lev, j, i) boolean mask of valid temperatures
+        Returns:
+            operator (scipy csr matrix): sector volume weights
+        """
+        area = np.ascontiguousarray(area_ds.areacello.fillna(0).values, dtype=float)
+        lev_bnds = np.ascontiguousarray(lev_bnds, dtype=float)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(area.tobytes())
+        digest.update(np.ascontiguousarray(flags.values).tobytes())
+        digest.update(lev_bnds.tobytes())
+        digest.update(np.packbits(valid).tobytes())
+        digest.update(str(valid.shape).encode())
+        for sector in self.sectors:
+            digest.update(repr((sector, self.select_depth_range(sector))).encode())
+        signature = digest.hexdigest()
+        cache_file = self.operator_cache_file()
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                if str(cached["signature"]) == signature:
+                    return sparse.csr_matrix(
+                        (cached["data"], cached["indices"], cached["indptr"]),
+                        shape=tuple(cached["shape"]),
+                    )
+        operator = self.weight_operator(area, flags, lev_bnds, valid)
+        with atomic_write(cache_file, "wb") as handle:
+            np.savez(
+                handle,
+                data=operator.data,
+                indices=operator.indices,
+                indptr=operator.indptr,
+                shape=np.array(operator.shape),
+                signature=np.array(signature),
+            )
+        return operator
+
+    def hyperslab(self, flags, lev_bnds):
+        """Find the smallest j and lev ranges of the ocean grid covering the
+        cells of all sectors and the layers of all sector depth ranges
+        Args:
+            flags (xarray dataarray): sector flags from sector_labels
+            lev_bnds (np.array): (lev, 2) ocean depth bands
+        Returns:
+            j_range, lev_range (slice): index ranges to read
+        """
+        rows = np.flatnonzero((flags != 0).any("i").values)
+        lev_weights = sum(
+            self.layer_weights(lev_bnds, *self.select_depth_range(sector))
+            for sector in self.sectors
+        )
+        levs = np.flatnonzero(lev_weights)
+        if rows.size == 0 or levs.size == 0:
+            return slice(0, 0), slice(0, 0)
+        return slice(rows[0], rows[-1] + 1), slice(levs[0], levs[-1] + 1)
+
+    def thetao_files(self):
+        """List the ocean temperature files
+        Returns:
+            list of file names (str)
+        """
+        if isinstance(self.thetao, str):
+            return [self.thetao]
+        return list(self.thetao)
+
+    def record_weights(self, thetao_ds):
+        """Length of the time bounds of each record of a file in seconds,
+        in the time units of the file when the bounds are not decoded to
+        dates, or equal weights when the file has no time bounds
+        Args:
+            thetao_ds (xarray dataset): ocean temperature dataset
+        Returns:
+            weights (np.array): weight of each record
+        """
+        if "time_counter_bounds" not in thetao_ds:
+            return np.ones(thetao_ds.sizes["time_counter"])
+        bounds = thetao_ds["time_counter_bounds"].values
+        delta = bounds[:, 1] - bounds[:, 0]
+        if np.issubdtype(delta.dtype, np.timedelta64):
+            return delta / np.timedelta64(1, "s")
+        if np.issubdtype(delta.dtype, np.number):
+            return np.asarray(delta, dtype=float)
+        return np.array([step.total_seconds() for step in delta])
+
+    def annual_mean(self, j_range, lev_range):
+        """Time-weighted mean of a hyperslab of thetao over all records of
+        all files, read one record at a time into a running sum
+        Args:
+            j_range, lev_range (slice): index ranges to read
+        Returns:
+            thetao_mean (np.array): (lev, j, i) mean, NaN where no record
+            has data
+        """
+        total = None
+        for thetao_file in self.thetao_files():
+            with xr.open_dataset(thetao_file) as thetao_ds:
+                weights = self.record_weights(thetao_ds)
+                thetao = thetao_ds["thetao"].transpose(
+                    "time_counter", "olevel", "y", "x"
+                )
+                for record, weight in enumerate(weights):
+                    values = np.asarray(
+                        thetao[record, lev_range, j_range].values, dtype=float
+                    )
+                    valid = np.isfinite(values)
+                    if total is None:
+                        total = np.zeros(values.shape)
+                        weight_sum = np.zeros(values.shape)
+                    total += weight * np.where(valid, values, 0.0)
+                    weight_sum += weight * valid
+        assert total is not None, "No thetao records found"
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(weight_sum > 0, total / weight_sum, np.nan)
+
+    def sector_means(self, operator, thetao, valid):
+        """Apply the sector volume weight operator to one or more records
+        Args:
+            operator (scipy csr matrix): sector volume weights
+            thetao (np.array): (lev, j, i) or (time, lev, j, i) temperature
+            valid (np.array): (lev, j, i) boolean mask of valid temperatures
+        Returns:
+            means (np.array): (sector,) or (time, sector) mean temperature
+        """
+        values = np.where(valid, thetao, 0.0).reshape(-1, valid.size)
+        means = (operator @ values.T).T
+        # Sectors without valid data
+        means[:, np.diff(operator.indptr) == 0] = np.nan
+        return means.reshape(thetao.shape[:-3] + (len(self.sectors),))
+
+    def record_sector_means(self, j_range, lev_range, area_ds, flags, lev_bnds):
+        """Volume weighted mean temperature of each sector for every record
+        of all files, reading record_chunk records at a time and applying
+        the sector operator with one sparse mat-mat product per chunk
+        Args:
+            j_range, lev_range (slice): index ranges to read
+            area_ds (xarray dataset): areacello dataset of the j range
+            flags (xarray dataarray): sector flags of the j range
+            lev_bnds (np.array): (lev, 2) ocean depth bands of the lev range
+        Returns:
+            means (np.array): (time, sector) mean temperature
+            times (np.array): time_counter of each record
+        """
+        means, times = [], []
+        operator = None
+        for thetao_file in self.thetao_files():
+            with xr.open_dataset(thetao_file) as thetao_ds:
+                thetao = thetao_ds["thetao"].transpose(
+                    "time_counter", "olevel", "y", "x"
+                )
+                if operator is None:
+                    # The land mask does not change between records
+                    valid = np.isfinite(thetao[0, lev_range, j_range].values)
+                    operator = self.sector_weights(area_ds, flags, lev_bnds, valid)
+                for start in range(0, thetao.shape[0], self.record_chunk):
+                    records = slice(start, start + self.record_chunk)
+                    chunk = np.asarray(
+                        thetao[records, lev_range, j_range].values, dtype=float
+                    )
+                    means.append(self.sector_means(operator, chunk, valid))
+                times.append(thetao_ds["time_counter"].values)
+        assert means, "No thetao records found"
+        return np.concatenate(means), np.concatenate(times)
+
+    def ocean_grid(self):
+        """Open the areacello dataset, the sector raster and the ocean depth
+        bands
+        Returns:
+            area_ds (xarray dataset): areacello dataset
+            flags (xarray dataarray): sector flags from sector_labels
+            lev_bnds (np.array): (lev, 2) ocean depth bands
+        """
+        thetao_ds, area_ds = self.open_datasets()
+        lev_bnds = thetao_ds["olevel_bounds"].values
+        thetao_ds.close()
+        flags = self.sector_defs.sector_labels(area_ds, self.sector_cache_file())
+        return area_ds, flags, lev_bnds
+
+    def depth_profiles(self):
+        """Area weighted annual mean temperature profile of each sector over
+        all levels, from one sparse mat-vec of the sector layer operator
+        Returns:
+            profiles (np.array): (sector, lev) temperature, NaN for layers
+            without valid data
+            lev_bnds (np.array): (lev, 2) ocean depth bands
+        """
+        area_ds, flags, lev_bnds = self.ocean_grid()
+        j_range = self.hyperslab(flags, lev_bnds)[0]
+        thetao_year = self.annual_mean(j_range, slice(None))
+        valid = np.isfinite(thetao_year)
+        area = area_ds.areacello.isel(j=j_range).fillna(0).values
+        area_ds.close()
+        profile = self.profile_operator(area, flags.isel(j=j_range), valid)
+        profiles = profile @ np.where(valid, thetao_year, 0.0).ravel()
+        profiles[np.diff(profile.indptr) == 0] = np.nan
+        return profiles.reshape(len(self.sectors), -1), lev_bnds
+
+    def depth_windows(self):
+        """Depth range of each sector
+        Returns:
+            tops, bottoms (np.array): (sector, 1) depth range limits
+        """
+        windows = np.array([self.select_depth_range(sector) for sector in self.sectors])
+        return windows[:, :1], windows[:, 1:]
+
+    def window_means(self, profiles, lev_bnds, tops, bottoms):
+        """Depth weighted mean of each sector profile over any number of
+        depth windows. The thickness weighted sums of the profiles and of
+        the thickness of layers with valid data are accumulated once over
+        the layer bounds; the sums over a window are differences of these
+        prefix sums interpolated at the window limits.
+        Args:
+            profiles (np.array): (sector, lev) temperature from depth_profiles
+            lev_bnds (np.array): (lev, 2) contiguous ocean depth bands
+            tops, bottoms (np.array): (window,) or (sector, window) depth
+            window limits
+        Returns:
+            means (np.array): (sector, window) depth weighted mean temperature,
+            NaN for windows without valid layers
+        """
+        assert np.allclose(lev_bnds[1:, 0], lev_bnds[:-1, 1]), "Layers not contiguous"
+        valid = np.isfinite(profiles)
+        thickness = lev_bnds[:, 1] - lev_bnds[:, 0]
+        edges = np.append(lev_bnds[0, 0], lev_bnds[:, 1])
+        start = np.zeros((len(profiles), 1))
+        heat = np.hstack(
+            [start, np.cumsum(np.where(valid, profiles * thickness, 0.0), axis=1)]
+        )
+        depth = np.hstack([start, np.cumsum(valid * thickness, axis=1)])
+        tops = np.asarray(tops, dtype=float) * np.ones((len(profiles), 1))
+        bottoms = np.asarray(bottoms, dtype=float) * np.ones((len(profiles), 1))
+        means = np.full(np.broadcast(tops, bottoms).shape, np.nan)
+        for row in range(len(profiles)):
+            heat_sum = np.interp(bottoms[row], edges, heat[row]) - np.interp(
+                tops[row], edges, heat[row]
+            )
+            depth_sum = np.interp(bottoms[row], edges, depth[row]) - np.interp(
+                tops[row], edges, depth[row]
+            )
+            np.divide(heat_sum, depth_sum, out=means[row], where=depth_sum > 0)
+        return means
+
+    def weighted_mean_df(self, time_resolved=False):
+        """Compute volume weighted mean for one year of thetao with one
+        sparse mat-vec of the cached sector volume weight operator. The
+        annual mean is accumulated over all thetao files, reading only the
+        hyperslab of thetao used by the sectors
         Args:
             area_file (str): file name for file containing areacello data
             thetao_file (str): file name for file containing ocean data
             sectors (list of str): list of sector names
+            time_resolved (bool): keep every record instead of the annual mean
         Returns:
-            df (pandas dataframe): dataframe with volume weighted mean for each sector
+            df (pandas dataframe): dataframe with volume weighted mean for each
+            sector, one row per record indexed by time_counter when
+            time_resolved
         """
-        # Open thetao dataset
-        thetao_ds, area_ds = self.open_datasets()
-        thetao_ds = thetao_ds.rename(
-            {
-                "y": "j",
-                "x": "i",
-                "nav_lon": "longitude",
-                "nav_lat": "latitude",
-                "olevel": "lev",
-            }
+        area_ds, flags, lev_bnds = self.ocean_grid()
+        # Only read the rows and levels used by the sectors
+        j_range, lev_range = self.hyperslab(flags, lev_bnds)
+        if time_resolved:
+            vwm_vals, times = self.record_sector_means(
+                j_range,
+                lev_range,
+                area_ds.isel(j=j_range),
+                flags.isel(j=j_range),
+                lev_bnds[lev_range],
+            )
+            area_ds.close()
+            index = pd.Index(times, name="time_counter")
+            return pd.DataFrame(vwm_vals, index=index, columns=self.sectors)
+
+        thetao_year = self.annual_mean(j_range, lev_range)  # Compute annual mean
+        valid = np.isfinite(thetao_year)
+        operator = self.sector_weights(
+            area_ds.isel(j=j_range), flags.isel(j=j_range), lev_bnds[lev_range], valid
         )
-        ds_thetao_year = thetao_ds["thetao"].mean("time_counter")  # Compute annual mean
-        ds_lev_bnds = thetao_ds["olevel_bounds"]
-        masks = levermann().sector_masks(area_ds)
-        vwm_vals = []
-        sects = []
-        # Loop over oceanic sectors
-        mean_df = pd.DataFrame()
-        for sector in self.sectors:
-            mask = masks[sector]
-            ds_sel = ds_thetao_year.where(mask)
-            thetao_awm = self.area_weighted_mean(ds_sel, area_ds)
-            thetao_vwm = self.sector_lev_mean(thetao_awm, ds_lev_bnds, sector)
-            vwm = float(thetao_vwm.values)
-            vwm_vals.append(vwm)
-            sects.append(sector)
-
-        ds_thetao_year.close()
+        vwm_vals = self.sector_means(operator, thetao_year, valid)
+
         area_ds.close()
-        mean_df = pd.DataFrame(columns=self.sectors)
-        series = pd.Series(vwm_vals, index=mean_df.columns)
-        mean_df = mean_df.append(series, ignore_index=True)
+        mean_df = pd.DataFrame([vwm_vals], columns=self.sectors)
         return mean_df
 
 
@@ -248,8 +643,12 @@ class BasalMelt(OceanData):
     c_po (float): specific heat capacity of ocean mixed layer J kg-1 K-1
     L_i (float): latent heat of fusion of ice
     Tf (float): Freezing temperature
-    baseline (float): baseline climate mean temperature
+    baseline (dict): baseline climate mean temperature of each sector,
+    read from baseline_file when given, the biased constants otherwise
     gamma (float): gamma value for chosen model
+    baselines (xarray dataarray): baseline temperature of each sector,
+    aligned with sectors
+    temperature_df (pandas dataframe): cached annual sector temperatures
 
     Methods
     -------
@@ -257,8 +656,16 @@ class BasalMelt(OceanData):
         Calculate quadratic constant
     quadBasalMelt
         Calculate basal melt
+    load_baseline
+        Read sector baselines from a baseline table
     BasalMeltAnomalies
         Calculate basal melt anomaly
+    sector_basal_melt
+        Calculate basal melt forcing from labelled sector temperatures
+    sector_temperatures
+        Annual sector temperatures, computed once
+    calibrate
+        Evaluate basal melt over a grid of gamma, Tf and baselines
     thetao2basalmelt
         Calculate basal melt from 3D ocean temperature file
     mapBasalMelt
@@ -271,6 +678,11 @@ class BasalMelt(OceanData):
     c_po = 3974.0
     L_i = 3.34 * 10**5
     Tf = -1.6
+    # piControl sector means from the reduction before lev_weighted_mean
+    # clipped a copy of olevel_bounds. It clipped them in place, so every
+    # sector after eais used the bounds of earlier depth windows. The wedd,
+    # amun, ross and apen values carry that bias against the current sector
+    # means; recompute them with compute_baseline.py and pass baseline_file.
     baseline = {
         "eais": 0.27209795341055726,
         "wedd": -1.471784486780416,
@@ -279,73 +691,221 @@ class BasalMelt(OceanData):
         "apen": -0.6192596251283067,
     }
 
-
-    def __init__(self, thetao, area, gamma):
-        OceanData.__init__(self, thetao, area)
+    def __init__(self, thetao, area, gamma, sector_defs=None, baseline_file=None):
+        OceanData.__init__(self, thetao, area, sector_defs)
         self.gamma = gamma * 0.65
+        self.temperature_df = None
+        if baseline_file is not None:
+            self.baseline = self.load_baseline(baseline_file)
+        else:
+            warnings.warn(
+                "No baseline_file given, using the BasalMelt baseline constants."
+                " They carry the olevel_bounds clipping bias, recompute the"
+                " baselines with compute_baseline.py",
+                stacklevel=2,
+            )
+        self.baselines = xr.DataArray(
+            [self.baseline.get(sector, np.nan) for sector in self.sectors],
+            dims="sector",
+            coords={"sector": self.sectors},
+            name="baseline",
+        )
 
-    def basal_melt_sensitivity(self):
+    def load_baseline(self, baseline_file):
+        """Read sector baselines from a baseline table
+        Args:
+            baseline_file (str): csv file with one row of sector baselines,
+            as written by Baseline.write
+        Returns:
+            baseline (dict): baseline temperature of each sector
+        """
+        baseline_df = pd.read_csv(baseline_file)
+        assert len(baseline_df) == 1, "Baseline table should have one row"
+        assert list(baseline_df.columns) == list(
+            self.sectors
+        ), "Baseline table columns should be the sectors"
+        return {sector: float(value) for sector, value in baseline_df.iloc[0].items()}
+
+    def basal_melt_sensitivity(self, gamma=None):
         """Calculate quadratic constant
+        Args:
+            gamma (float or np.array): scaled gamma, self.gamma by default
         Returns:
             melt_sensitivity (float) quadratic constant value
         """
+        if gamma is None:
+            gamma = self.gamma
         c_lin = (self.rho_sw * self.c_po) / (self.rho_i * self.L_i)
         c_quad = (c_lin) ** 2
-        melt_sensitivity = self.gamma * 10**5 * c_quad  # Quadratic constant
+        melt_sensitivity = gamma * 10**5 * c_quad  # Quadratic constant
         return melt_sensitivity
 
-    def quadratic_basal_melt(self, thetao):
+    def quadratic_basal_melt(self, thetao, melt_sensitivity=None, freezing_temp=None):
         """Calculate basal melt
         Args:
             thetao (float): ocean temperature value
+            melt_sensitivity (float or np.array): quadratic constant, from
+            self.gamma by default
+            freezing_temp (float or np.array): freezing temperature, self.Tf
+            by default
         Returns:
             bm (float): basal melt value
         """
-        melt_sensitivity = self.basal_melt_sensitivity()
-        basalmelt = (thetao - self.Tf) * (abs(thetao - self.Tf)) * melt_sensitivity
+        if melt_sensitivity is None:
+            melt_sensitivity = self.basal_melt_sensitivity()
+        if freezing_temp is None:
+            freezing_temp = self.Tf
+        basalmelt = (
+            (thetao - freezing_temp) * (abs(thetao - freezing_temp)) * melt_sensitivity
+        )
         return basalmelt
 
     def basal_melt_anomalies(self, thetao, base):
-        """Calculate basal melt anomaly
+        """Calculate basal melt anomaly, broadcast over arrays of
+        temperatures and baselines
         Args:
-            thetao (float): ocean temperature value
-            base (float): ocean temperature baseline value
+            thetao (float or array): ocean temperature value
+            base (float or array): ocean temperature baseline value
         Returns:
-            dBM (float) basal melt anomaly
+            dBM (float or array) basal melt anomaly
         """
         basalmelt_base = self.quadratic_basal_melt(base)
         basalmelt = self.quadratic_basal_melt(thetao)
         delta_basalmelt = basalmelt - basalmelt_base
-        assert delta_basalmelt < 100, "Basal melt too unrealistic"
-        assert delta_basalmelt > -100, "Basal melt too unrealistic"
+        assert np.all(delta_basalmelt < 100), "Basal melt too unrealistic"
+        assert np.all(delta_basalmelt > -100), "Basal melt too unrealistic"
         return delta_basalmelt
 
-    def thetao2basalmelt(self):
+    def sector_basal_melt(self, thetao):
+        """Calculate basal melt forcing from sector temperatures of any
+        shape, e.g. (member, time, sector), against the sector baselines
+        Args:
+            thetao (xarray dataarray or np.array): temperatures with a sector
+            dimension, or an array whose last axis follows self.sectors
+        Returns:
+            basalmelt (xarray dataarray): basal melt forcing, minus the
+            basal melt anomaly, with the dimensions of thetao
+        """
+        if not isinstance(thetao, xr.DataArray):
+            thetao = np.asarray(thetao, dtype=float)
+            dims = ["dim_%d" % axis for axis in range(thetao.ndim - 1)]
+            thetao = xr.DataArray(
+                thetao, dims=dims + ["sector"], coords={"sector": self.sectors}
+            )
+        base = self.baselines.sel(sector=thetao["sector"])
+        assert not base.isnull().any(), "No baseline for some sectors"
+        basalmelt = -self.basal_melt_anomalies(thetao, base)
+        return basalmelt.rename("basal_melt")
+
+    def sector_temperatures(self):
+        """Annual volume weighted mean temperature of each sector, computed
+        on the first call and reused afterwards
+        Returns:
+            temperature_df (pandas dataframe): one row of sector temperatures
+        """
+        if self.temperature_df is None:
+            self.temperature_df = self.weighted_mean_df()
+        return self.temperature_df
+
+    def calibrate(self, gammas, freezing_temps=None, baselines=None):
+        """Evaluate the quadratic melt law for every combination of gamma,
+        freezing temperature and baseline on the cached sector temperatures,
+        broadcast over (gamma, Tf, baseline, sector). The range checks of
+        basal_melt_anomalies are not applied.
+        Args:
+            gammas (array-like): gamma values, scaled like the gamma argument
+            of BasalMelt
+            freezing_temps (array-like): freezing temperatures, [self.Tf] by
+            default
+            baselines (list of dict or pandas dataframe): baseline
+            temperature sets, one row per set, [self.baseline] by default
+        Returns:
+            calibration_df (pandas dataframe): one row per parameter
+            combination and sector with columns gamma, Tf, baseline (row of
+            the baseline set), sector, thetao, melt and basal_melt (the
+            forcing value of thetao2basalmelt)
+        """
+        temperature_df = self.sector_temperatures()
+        sectors = list(temperature_df.columns)
+        if freezing_temps is None:
+            freezing_temps = [self.Tf]
+        if baselines is None:
+            baselines = [self.baseline]
+        gammas = np.asarray(gammas, dtype=float)
+        freezing_temps = np.asarray(freezing_temps, dtype=float)
+        base = pd.DataFrame(baselines, columns=sectors).values.astype(float)
+        thetao = temperature_df.values[0].astype(float)
+
+        sensitivity = self.basal_melt_sensitivity(gammas * 0.65)[:, None, None, None]
+        freezing = freezing_temps[None, :, None, None]
+        melt = self.quadratic_basal_melt(thetao, sensitivity, freezing)
+        melt_base = self.quadratic_basal_melt(base[None, None], sensitivity, freezing)
+        shape = (len(gammas), len(freezing_temps), len(base), len(sectors))
+        index = np.indices(shape).reshape(len(shape), -1)
+        calibration_df = pd.DataFrame(
+            {
+                "gamma": gammas[index[0]],
+                "Tf": freezing_temps[index[1]],
+                "baseline": index[2],
+                "sector": np.array(sectors)[index[3]],
+                "thetao": thetao[index[3]],
+                "melt": np.broadcast_to(melt, shape).ravel(),
+                "basal_melt": (melt_base - melt).ravel(),
+            }
+        )
+        return calibration_df
+
+    def thetao2basalmelt(self, time_resolved=False):
         """Calculate basal melt from 3D ocean temperature file
+        Args:
+            time_resolved (bool): one row per record instead of the annual mean
         Returns:
             df2 (pandas dataframe) values of basal melt for each Antarctic region
         """
-        wmean_df = self.weighted_mean_df()
-        basalmelt_df = pd.DataFrame()
-        for column in wmean_df:
-            thetao = wmean_df[column].values
-            base = self.baseline.get(column)
-            delta_basalmelt = self.basal_melt_anomalies(thetao, base)
-            basalmelt_df[column] = -delta_basalmelt
+        if time_resolved:
+            wmean_df = self.weighted_mean_df(time_resolved)
+        else:
+            wmean_df = self.sector_temperatures()
+        basalmelt = self.sector_basal_melt(wmean_df.values)
+        basalmelt_df = pd.DataFrame(
+            basalmelt.values, index=wmean_df.index, columns=wmean_df.columns
+        )
         assert basalmelt_df.empty is False, "Dataframe should not be empty"
         print(basalmelt_df)
         return basalmelt_df
 
-    def map_basalmelt(self, mask_path, nc_out, driver, name):
+    def map_basalmelt(
+        self,
+        mask_path,
+        nc_out,
+        driver,
+        name,
+        time_step=None,
+        start_time=0.0,
+        time_resolved=False,
+    ):
         """Calculate basal melt values and map to Antarctic sectors
         Args:
             mask_path (str): path to mask files
             nc_out (str): path to where basal melt file will be output
             driver (str): path to filetools driver
             name (str): name of basal melt file
+            time_step (float): time between basal melt rows in years, to
+            write every row as a numbered record
+            start_time (float): time of the first row in years
+            time_resolved (bool): one row per thetao record instead of the
+            annual mean
         Returns:
             basal melt dataframe and produces netcdf and hdf5 files
         """
-        basalmelt_df = self.thetao2basalmelt()
-        levermann().map2amr(mask_path, nc_out, driver, name, basalmelt_df)
+        basalmelt_df = self.thetao2basalmelt(time_resolved)
+        self.sector_defs.map2amr(
+            mask_path,
+            nc_out,
+            driver,
+            name,
+            basalmelt_df,
+            time_step=time_step,
+            start_time=start_time,
+        )
         return basalmelt_df
@@ -0,0 +1,175 @@
+"""This module computes the sector temperature baselines of BasalMelt
+from piControl ocean output
+
+Classes: Baseline
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+from freshwater_coupling.amr_tools import atomic_write
+from freshwater_coupling.basal_melt import OceanData
+
+
+class Baseline:
+    """Class for the time mean sector temperature of many ocean files
+    ...
+
+    Every file is reduced with the OceanData sector reduction in a process
+    pool. The time weighted sums of each file are checkpointed as soon as
+    the file is done, so an interrupted run resumes with the remaining
+    files.
+
+    Attributes
+    ----------
+    thetao_files (list of str): names of ocean temperature files
+    area (str): name of areacello file
+    sector_defs: PolygonSectors, None for the Levermann sectors
+    checkpoint (str): name of json checkpoint file
+    max_workers (int): number of processes
+
+    Methods
+    -------
+    ocean_data
+        OceanData of one file
+    sectors
+        Sector names
+    signature
+        Signature of the sector reduction
+    load_checkpoint
+        Read the partial sums of the files done so far
+    save_checkpoint
+        Write the partial sums atomically
+    file_sums
+        Time weighted sector temperature sums of one file
+    compute
+        Time mean sector temperature over all files
+    write
+        Write the baseline table
+    """
+
+    def __init__(
+        self, thetao_files, area, sector_defs=None, checkpoint=None, max_workers=None
+    ):
+        self.thetao_files = sorted(thetao_files)
+        self.area = area
+        self.sector_defs = sector_defs
+        self.checkpoint = checkpoint
+        self.max_workers = max_workers
+
+    def ocean_data(self, thetao_file):
+        """OceanData of one file
+        Args:
+            thetao_file (str): name of ocean temperature file
+        Returns:
+            OceanData
+        """
+        return OceanData(thetao_file, self.area, self.sector_defs)
+
+    def sectors(self):
+        """Sector names
+        Returns:
+            list of sector names
+        """
+        return list(self.ocean_data(None).sectors)
+
+    def signature(self):
+        """Signature of the sector reduction, checkpoints with another
+        signature are discarded
+        Returns:
+            signature (str)
+        """
+        ocean = self.ocean_data(None)
+        windows = [ocean.select_depth_range(sector) for sector in ocean.sectors]
+        return json.dumps(
+            [
+                os.path.abspath(self.area),
+                ocean.sector_defs.signature(),
+                ocean.sectors,
+                [[float(top), float(bottom)] for top, bottom in windows],
+            ]
+        )
+
+    def load_checkpoint(self):
+        """Read the partial sums of the files done so far
+        Returns:
+            dictionary of file name and weight and sums
+        """
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return {}
+        with open(self.checkpoint) as handle:
+            checkpoint = json.load(handle)
+        if checkpoint["signature"] != self.signature():
+            return {}
+        return checkpoint["files"]
+
+    def save_checkpoint(self, files):
+        """Write the partial sums atomically
+        Args:
+            files (dict): file name and weight and sums
+        """
+        if self.checkpoint is None:
+            return
+        checkpoint = {"signature": self.signature(), "files": files}
+        with atomic_write(self.checkpoint) as handle:
+            json.dump(checkpoint, handle)
+
+    def file_sums(self, thetao_file):
+        """Time weighted sector temperature sums of one file
+        Args:
+            thetao_file (str): name of ocean temperature file
+        Returns:
+            thetao_file (str), weight (float): total length of the records
+            and sums (list): weighted sector temperature sums
+        """
+        ocean = self.ocean_data(thetao_file)
+        means = ocean.weighted_mean_df().values[0].astype(float)
+        with xr.open_dataset(thetao_file) as thetao_ds:
+            weight = float(ocean.record_weights(thetao_ds).sum())
+        return thetao_file, weight, (means * weight).tolist()
+
+    def compute(self):
+        """Time mean sector temperature over all files, resuming from the
+        checkpoint
+        Returns:
+            baseline_df (pandas dataframe): one row of sector baselines
+        """
+        assert self.thetao_files, "No thetao files found"
+        files = self.load_checkpoint()
+        todo = [name for name in self.thetao_files if name not in files]
+        if todo:
+            # The first file builds the sector raster and weight operator
+            # caches before the workers read them
+            name, weight, sums = self.file_sums(todo[0])
+            files[name] = {"weight": weight, "sums": sums}
+            self.save_checkpoint(files)
+        if len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = [pool.submit(self.file_sums, name) for name in todo[1:]]
+                for future in as_completed(futures):
+                    name, weight, sums = future.result()
+                    files[name] = {"weight": weight, "sums": sums}
+                    self.save_checkpoint(files)
+                    print(
+                        "Baseline: %d of %d files done"
+                        % (len(files), len(self.thetao_files))
+                    )
+        weight = sum(files[name]["weight"] for name in self.thetao_files)
+        sums = np.sum([files[name]["sums"] for name in self.thetao_files], axis=0)
+        baseline_df = pd.DataFrame([sums / weight], columns=self.sectors())
+        return baseline_df
+
+    def write(self, csv_file):
+        """Compute the baselines and write the baseline table
+        Args:
+            csv_file (str): name of csv file
+        Returns:
+            baseline_df (pandas dataframe): one row of sector baselines
+        """
+        baseline_df = self.compute()
+        with atomic_write(csv_file) as handle:
+            baseline_df.to_csv(handle, index=False)
+        return baseline_df
@@ -4,12 +4,16 @@ calculations for different regions of Antarctica
 Classes: Freshwater
 """
 
+from concurrent.futures import ProcessPoolExecutor
+import os
 import numpy as np
 import pandas as pd
 import xarray as xr
-from scipy import ndimage
+from freshwater_coupling.amr_tools import ORIGIN, ChomboFile
 from freshwater_coupling.amr_tools import Flatten as flt
+from freshwater_coupling.amr_tools import FlattenCache
 from freshwater_coupling.amr_tools import Masks as bisi_masks
+from freshwater_coupling.antarctic_sectors import LevermannSectors as levermann
 
 
 class Freshwater:
@@ -22,6 +26,8 @@ class Freshwater:
     flatten (str): path to flatten driver
     file1 (str): file1 name
     file2 (str): file2 name
+    timeout (float): seconds to wait for each flatten driver call
+    variables (list): plot file variables read for the freshwater budget
 
     Methods
     -------
@@ -35,33 +41,44 @@ class Freshwater:
         Calving Contribution
     AntarcticBasalContribution
         Basal Melt Contribuition
-    maskRegion
-        Downsample masks, mask out region, take sum, output to dataframe
-    Contributions
-        Calving and Basal melt contribution for each region of Antarctica
+    open_plot_files
+        Load both BISICLES plot files concurrently
+    region_sums
+        Sum each variable over all regions with one bincount per variable
+    regional_budget
+        Calving and Basal melt contribution from regional sums
     RegionalContribution
         Calving and Basal melt contribution for each region of Antarctica
+    amr_regional_contribution
+        Calving and Basal melt contribution for each region of Antarctica,
+        integrated over all amr levels
     """
 
     area = 64000000
+    # Plot file variables needed for the freshwater budget
+    variables = [
+        "thickness",
+        "activeSurfaceThicknessSource",
+        "activeBasalThicknessSource",
+    ]
     kg_per_Gt = 1e12  # [kg] to [Gt]
     spy = 3600 * 24 * 365  # [s yr^-1]
 
-    def __init__(self, flatten, amr_file1, amr_file2):
+    def __init__(self, flatten, amr_file1, amr_file2, timeout=None):
         self.flatten = flatten
         self.amr_file1 = amr_file1
         self.amr_file2 = amr_file2
+        self.timeout = timeout
 
     def region(self, mask_path):
-        """Get region masks and extract them
+        """Get region label raster of the masks
         Args:
             mask_path (str): path to amr mask files
         Returns:
-            x,y: co-ordinate series
-            masks:  np.array of Anatrctica sectore masks
+            RegionLabels of the Antarctic regions
         """
-        x, y, masks = bisi_masks(mask_path).bisicles_masks()
-        return x, y, masks
+        labels = bisi_masks(mask_path, levermann()).region_labels()
+        return labels
 
     def get_sum(self, file):
         """Get the sum for each variable based on a file
@@ -100,47 +117,92 @@ class Freshwater:
         bmb_gt = bmb_vol / (10**9) * (917.0 / 1000)
         return -bmb_gt
 
-    def mask_region(self, plot_dat, mask_dat):
-        """Downsample masks, mask out region, take sum, output to dataframe
+    def open_plot_files(self, nc_out, driver, cache=None):
+        """Load both BISICLES plot files concurrently. h5py holds a global
+        lock around every call, so native reads in two threads would run one
+        after the other; the files not in the cache are read in separate
+        processes instead, and the cache is only used by this process
+        Args:
+            nc_out (str): path to netcdf output
+            driver (str): BISICLES flatten driver path
+            cache (FlattenCache): cache of flattened files, optional
+        Returns:
+            xarray datasets of the flattened plot files at timestep 1 and 2
+        """
+        files = [self.amr_file1, self.amr_file2]
+        dats = {}
+        keys = {}
+        if cache is not None:
+            for file in files:
+                keys[file] = cache.key(file, 0, ORIGIN, self.variables)
+                dats[file] = cache.get(keys[file])
+        todo = [file for file in files if dats.get(file) is None]
+        if todo:
+            with ProcessPoolExecutor(max_workers=len(todo)) as pool:
+                futures = [
+                    pool.submit(
+                        flt(file).open,
+                        driver,
+                        nc_out,
+                        None,
+                        self.timeout,
+                        self.variables,
+                    )
+                    for file in todo
+                ]
+                for file, future in zip(todo, futures):
+                    try:
+                        dats[file] = future.result()
+                    except Exception as err:
+                        raise RuntimeError(
+                            "Loading " + file + " failed: " + str(err)
+                        ) from err
+                    if cache is not None:
+                        cache.put(keys[file], dats[file])
+                        # The cache keeps its own copy of a flattened file
+                        nc_name = nc_out + flt(file).find_name() + ".nc"
+                        if os.path.exists(nc_name):
+                            os.remove(nc_name)
+        return dats[files[0]], dats[files[1]]
+
+    def region_sums(self, plot_dat, labels, variables=None):
+        """Sum each variable over all regions with one bincount per variable
         Args:
             plot_dat (xarray dataset): xarray dataset of BISICLES plot file
-            mask_dat (xarray dataset): xarray dataset of original mask file
+            labels (RegionLabels): region labels on the grid of the plot file
+            variables (list): names of variables to sum, all if None
         Returns:
-            df (pandas dataframe): Dataframe of sum of each variable in
-            BISICLES plot file for a certain region
+            sum_df (pandas dataframe): Dataframe of sum of each variable
+            (columns) for each region (index)
         """
-        mask_int = mask_dat.astype(int)
-        new_mask = ndimage.interpolation.zoom(mask_int, 0.125)
+        if variables is None:
+            variables = list(plot_dat.data_vars)
         assert (
-            plot_dat.thickness.shape == new_mask.shape
+            plot_dat[variables[0]].shape == labels.labels.shape
         ), "arrays are not the same shape"
-        cols = []
-        sums = []
-        for i in plot_dat:
-            area = np.array(plot_dat[i])
-            mask_area = np.where(new_mask == 1, area, np.nan)
-            mask_sum = np.nansum(mask_area)
-            cols.append(i)
-            sums.append(mask_sum)
-        sum_df = pd.DataFrame(columns=cols)
-        series = pd.Series(sums, index=sum_df.columns)
-        sum_df = sum_df.append(series, ignore_index=True)
+        flat_labels = labels.labels.ravel()
+        ids = np.array(list(labels.names))
+        sums = {}
+        for name in variables:
+            values = np.nan_to_num(np.asarray(plot_dat[name].values, dtype=float))
+            region_sum = np.bincount(
+                flat_labels, weights=values.ravel(), minlength=ids.max() + 1
+            )
+            sums[name] = region_sum[ids]
+        sum_df = pd.DataFrame(sums, index=[labels.names[key] for key in ids])
         assert sum_df.empty is False, "Dataframe is empty"
         return sum_df
 
-    def contributions(self, dat1, dat2, mask_file):
-        """Calving and Basal melt contribution for a certain region of
-        Antarctica
+    def regional_budget(self, df1, df2):
+        """Calving and Basal melt contribution from regional sums
         Args:
-            dat1 (xarray dataset): BISICLES plot file timestep 1
-            dat2 (xarray dataset): BISICLES plot file timestep 2
-            mask_file (xarray dataset): mask file of region
-        returns:
-            calving_flux (float): Calving contribution in gigatonnes and bmb (float)
-            basal melt contribution in gigatonnes
+            df1 (pandas dataframe): regional sums of BISICLES plot file timestep 1
+            df2 (pandas dataframe): regional sums of BISICLES plot file timestep 2
+        Returns:
+            discharge_df (pandas dataframe) and
+            basal_df (pandas dataframe): dataframes of calving
+            and basal melt contribution for all regions of Antarctica
         """
-        df1 = self.mask_region(dat1, mask_file)
-        df2 = self.mask_region(dat2, mask_file)
         calving_flux = self.calving(
             df2.activeSurfaceThicknessSource * self.area,
             df2.activeBasalThicknessSource * self.area,
@@ -148,30 +210,48 @@ class Freshwater:
             df2.thickness * self.area,
         )
         bmb = self.basal_melt(df2.activeBasalThicknessSource)
-        return calving_flux, bmb
+        discharge_df = calving_flux.to_frame().T.reset_index(drop=True)
+        basal_df = bmb.to_frame().T.reset_index(drop=True)
+        return discharge_df, basal_df
 
-    def regional_contribution(self, mask_path, nc_out, driver):
+    def regional_contribution(self, mask_path, nc_out, driver, method="flatten"):
         """Calving and Basal melt contribution for each region of Antarctica
         Args:
             mask_path (str): path to mask files
             nc_out (str): path to netcdf output
             driver (str): BISICLES nc2amr driver path
+            method (str): "flatten" to use level 0 flattened files, "amr"
+            to integrate over all amr levels
+        Returns:
+            discharge_df (pandas dataframe) and
+            basal_df (pandas dataframe): dataframes of calving
+            and basal melt contribution for all regions of Antarctica
+        """
+        if method == "amr":
+            return self.amr_regional_contribution(mask_path)
+        assert method == "flatten", "method should be flatten or amr"
+        pyramid = bisi_masks(mask_path, levermann()).label_pyramid()
+        dat1, dat2 = self.open_plot_files(nc_out, driver, FlattenCache(nc_out))
+        plot_labels = pyramid.select(dat1.thickness.shape)
+        df1 = self.region_sums(dat1, plot_labels, self.variables)
+        df2 = self.region_sums(dat2, plot_labels, self.variables)
+        discharge_df, basal_df = self.regional_budget(df1, df2)
+        return discharge_df, basal_df
+
+    def amr_regional_contribution(self, mask_path):
+        """Calving and Basal melt contribution for each region of Antarctica,
+        integrated over the valid cells of all amr levels
+        Args:
+            mask_path (str): path to mask files
         Returns:
             discharge_df (pandas dataframe) and
             basal_df (pandas dataframe): dataframes of calving
             and basal melt contribution for all regions of Antarctica
         """
-        x, y, masks = self.region(mask_path)
-        dat1 = flt(self.amr_file1).open(driver, nc_out)
-        dat2 = flt(self.amr_file2).open(driver, nc_out)
-        discharge = {}
-        basal = {}
-        for key, mask in masks.items():
-            calving_flux, bmb = self.contributions(dat1, dat2, mask)
-            discharge[key] = calving_flux
-            basal[key] = bmb
-        discharge_df = pd.DataFrame.from_dict(discharge)
-        basal_df = pd.DataFrame.from_dict(basal)
+        labels = self.region(mask_path)
+        df1 = ChomboFile(self.amr_file1).region_sums(labels, self.variables)
+        df2 = ChomboFile(self.amr_file2).region_sums(labels, self.variables)
+        discharge_df, basal_df = self.regional_budget(df1, df2)
         return discharge_df, basal_df
 
     def areaflux_calculation(self, fwf_df, distribution_area, distribution_mask):
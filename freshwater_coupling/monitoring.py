@@ -0,0 +1,286 @@
+"""This module keeps the monitoring products of the coupling up to date,
+one leg at a time
+
+Classes: Monitoring
+"""
+
+import json
+import os
+import numpy as np
+import pandas as pd
+from freshwater_coupling.amr_tools import atomic_write
+
+
+class Monitoring:
+    """Class for monitoring products updated incrementally every leg
+    ...
+
+    The running state (a ring buffer of the last window years of sector
+    temperatures and the cumulative freshwater forcing anomaly) is kept in
+    a json file, so each leg only appends one row to each product csv.
+    The freshwater forcing anomaly is the total freshwater forcing minus
+    the freshwater baseline, and is only written when a baseline is given.
+    Rerunning the last leg rolls the state and the csv files back to before
+    that leg first, so updates are idempotent.
+
+    Attributes
+    ----------
+    path (str): directory of the state and product files
+    exp_name (str): experiment name
+    name (str): name of the state, engines updated by different scripts
+    need different names
+    window (int): number of years of the running mean
+    freshwater_baseline (dict): baseline total freshwater forcing of each
+    region, read from baseline_file when given
+
+    Methods
+    -------
+    product_file
+        Name of the csv file of a product
+    state_file
+        Name of the state file
+    new_state
+        Empty state
+    load_state
+        Read the state
+    save_state
+        Write the state atomically
+    load_baseline
+        Read the freshwater baseline from a baseline table
+    rollback
+        Restore the state and product files from before the last leg
+    row_values
+        Values of a one-row dataframe or series
+    advance
+        Update the state with the results of one leg
+    append_rows
+        Append one row to each product csv
+    update
+        Update the state and product files with the results of one leg
+    """
+
+    products = [
+        "OceanSectorThetao",
+        "OceanSectorThetao_30yRM",
+        "BasalMeltAnomaly",
+        "CumulativeFreshwaterForcingAnomaly",
+        "TotalFreshwaterForcing",
+    ]
+
+    def __init__(
+        self,
+        path,
+        exp_name,
+        name="monitoring",
+        window=30,
+        freshwater_baseline=None,
+        baseline_file=None,
+    ):
+        self.path = path
+        self.exp_name = exp_name
+        self.name = name
+        self.window = window
+        self.freshwater_baseline = freshwater_baseline or {}
+        if baseline_file is not None:
+            self.freshwater_baseline = self.load_baseline(baseline_file)
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def product_file(self, product):
+        """Name of the csv file of a product
+        Args:
+            product (str): product name
+        Returns:
+            csv file name (str)
+        """
+        return os.path.join(self.path, product + "_" + self.exp_name + ".csv")
+
+    def state_file(self):
+        """Name of the state file
+        Returns:
+            json file name (str)
+        """
+        return os.path.join(self.path, self.exp_name + "_" + self.name + "_state.json")
+
+    def new_state(self):
+        """Empty state
+        Returns:
+            dictionary of the state
+        """
+        return {
+            "year": None,
+            "window": self.window,
+            "sectors": None,
+            "ring": [],
+            "ring_index": 0,
+            "regions": None,
+            "cumulative": None,
+            "offsets": {},
+            "previous": None,
+        }
+
+    def load_state(self):
+        """Read the state
+        Returns:
+            dictionary of the state, empty if there is no state file
+        """
+        if not os.path.exists(self.state_file()):
+            return self.new_state()
+        with open(self.state_file()) as handle:
+            state = json.load(handle)
+        assert state["window"] == self.window, "Running mean window changed"
+        return state
+
+    def save_state(self, state):
+        """Write the state atomically
+        Args:
+            state (dict): state
+        """
+        with atomic_write(self.state_file()) as handle:
+            json.dump(state, handle)
+
+    def load_baseline(self, baseline_file):
+        """Read the freshwater baseline from a baseline table
+        Args:
+            baseline_file (str): csv file with one row of the baseline total
+            freshwater forcing of each region
+        Returns:
+            freshwater_baseline (dict): baseline of each region
+        """
+        baseline_df = pd.read_csv(baseline_file)
+        assert len(baseline_df) == 1, "Baseline table should have one row"
+        return {region: float(value) for region, value in baseline_df.iloc[0].items()}
+
+    def rollback(self, state):
+        """Restore the state and product files from before the last leg
+        Args:
+            state (dict): state after the last leg
+        Returns:
+            state (dict): state before the last leg
+        """
+        for product, offset in state["offsets"].items():
+            csv_file = self.product_file(product)
+            if not os.path.exists(csv_file):
+                continue
+            if offset == 0:
+                # The leg created the file, rewrite it with its header
+                os.remove(csv_file)
+            else:
+                with open(csv_file, "r+") as handle:
+                    handle.truncate(offset)
+        return state["previous"]
+
+    def row_values(self, data):
+        """Values of a one-row dataframe or series
+        Args:
+            data (pandas dataframe or series): one value per sector or region
+        Returns:
+            names (list) and values (np.array)
+        """
+        if isinstance(data, pd.DataFrame):
+            assert len(data) == 1, "Expected one row per leg"
+            data = data.iloc[0]
+        return [str(name) for name in data.index], data.values.astype(float)
+
+    def advance(self, state, year, thetao=None, basal_melt=None, freshwater=None):
+        """Update the state with the results of one leg
+        Args:
+            state (dict): state before the leg
+            year (int): year of the leg
+            thetao (pandas dataframe): sector temperatures
+            basal_melt (pandas dataframe): basal melt anomalies
+            freshwater (pandas dataframe): total freshwater forcing of each
+            region
+        Returns:
+            state (dict): state after the leg
+            rows (dict): product name and pandas series to append
+        """
+        state = dict(state, year=year)
+        rows = {}
+        if thetao is not None:
+            sectors, values = self.row_values(thetao)
+            if state["sectors"] is None:
+                state["sectors"] = sectors
+            assert state["sectors"] == sectors, "Sectors changed"
+            ring = [list(slot) for slot in state["ring"]]
+            if len(ring) < self.window:
+                ring.append(values.tolist())
+            else:
+                ring[state["ring_index"]] = values.tolist()
+            state["ring"] = ring
+            state["ring_index"] = (state["ring_index"] + 1) % self.window
+            rows["OceanSectorThetao"] = pd.Series(values, index=sectors)
+            rows["OceanSectorThetao_30yRM"] = pd.Series(
+                np.mean(ring, axis=0), index=sectors
+            )
+        if basal_melt is not None:
+            sectors, values = self.row_values(basal_melt)
+            rows["BasalMeltAnomaly"] = pd.Series(values, index=sectors)
+        if freshwater is not None:
+            regions, values = self.row_values(freshwater)
+            if state["regions"] is None:
+                state["regions"] = regions
+                state["cumulative"] = [0.0] * len(regions)
+            assert state["regions"] == regions, "Regions changed"
+            rows["TotalFreshwaterForcing"] = pd.Series(values, index=regions)
+            if self.freshwater_baseline:
+                assert set(regions) <= set(
+                    self.freshwater_baseline
+                ), "No freshwater baseline for some regions"
+                baseline = np.array(
+                    [self.freshwater_baseline[region] for region in regions]
+                )
+                cumulative = np.array(state["cumulative"]) + values - baseline
+                state["cumulative"] = cumulative.tolist()
+                rows["CumulativeFreshwaterForcingAnomaly"] = pd.Series(
+                    cumulative, index=regions
+                )
+        return state, rows
+
+    def append_rows(self, year, rows):
+        """Append one row to each product csv
+        Args:
+            year (int): year of the leg
+            rows (dict): product name and pandas series
+        """
+        for product, row in rows.items():
+            csv_file = self.product_file(product)
+            row_df = row.to_frame().T
+            row_df.insert(0, "year", year)
+            header = not os.path.exists(csv_file) or os.path.getsize(csv_file) == 0
+            row_df.to_csv(csv_file, mode="a", header=header, index=False)
+
+    def update(self, year, thetao=None, basal_melt=None, freshwater=None):
+        """Update the state and product files with the results of one leg.
+        The new state, holding the product file sizes before the leg, is
+        saved before the rows are appended, so a leg interrupted or rerun
+        is rolled back to those sizes when it is run again.
+        Args:
+            year (int): year of the leg
+            thetao (pandas dataframe): sector temperatures
+            basal_melt (pandas dataframe): basal melt anomalies
+            freshwater (pandas dataframe): total freshwater forcing of each
+            region
+        Returns:
+            rows (dict): product name and pandas series appended
+        """
+        state = self.load_state()
+        if state["year"] is not None and year == state["year"]:
+            state = self.rollback(state)
+        assert state["year"] is None or year > state["year"], (
+            "Leg %d is older than the last monitored leg" % year
+        )
+        previous = state
+        state, rows = self.advance(state, year, thetao, basal_melt, freshwater)
+        state["offsets"] = {}
+        for product in rows:
+            csv_file = self.product_file(product)
+            if os.path.exists(csv_file):
+                state["offsets"][product] = os.path.getsize(csv_file)
+            else:
+                state["offsets"][product] = 0
+        # Only the leg before is kept, older legs cannot be rolled back
+        state["previous"] = dict(previous, previous=None)
+        self.save_state(state)
+        self.append_rows(year, rows)
+        return rows
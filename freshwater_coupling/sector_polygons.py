@@ -0,0 +1,213 @@
+"""
+This module contains sectors defined by longitude/latitude polygons
+read from a config file
+
+Classes: PolygonSectors
+"""
+
+import json
+import os
+import numpy as np
+import xarray as xr
+from freshwater_coupling.amr_tools import RegionLabels
+from freshwater_coupling.antarctic_sectors import LevermannSectors
+
+
+class PolygonSectors(LevermannSectors):
+    """Class for sectors defined by polygons in a json config file
+    ...
+
+    Attributes
+    ----------
+    config_file (str): name of json config file
+    name (str): name of the sector definitions
+    polygons (dict): sector name and list of (vertex, 2) np.array polygons
+    of (longitude, latitude) vertices, longitude in [0, 360]
+    ice_polygons (dict): polygons of the sectors on the ice sheet, from the
+    optional ice_sectors of the config
+    sector_ids (dict): sector name and region id, in config order
+    find_shelf_depth (dict): shelf base depth of each sector
+    bin_size (float): size in degrees of the bins of the point index
+
+    Methods
+    -------
+    signature
+        json string of the sector definitions
+    contains
+        Test which points are inside a polygon
+    classify
+        Classify points into sectors
+    sector_masks
+        create dictionary of masks
+    sector_raster
+        Build the int8 sector id raster of the ocean grid
+    sector_mask
+        Select the mask of one sector from the sector id raster
+    bisicles_labels
+        Classify the cells of the BISICLES grid into sectors
+    """
+
+    default_config = os.path.join(
+        os.path.dirname(__file__), "sectors", "levermann_polygons.json"
+    )
+
+    def __init__(self, config_file=None):
+        if config_file is None:
+            config_file = self.default_config
+        self.config_file = config_file
+        with open(config_file) as handle:
+            self.config = json.load(handle)
+        self.name = self.config.get("name", "polygons")
+        self.polygons = {
+            name: [np.array(polygon, dtype=float) for polygon in polygons]
+            for name, polygons in self.config["sectors"].items()
+        }
+        self.ice_polygons = {
+            name: [np.array(polygon, dtype=float) for polygon in polygons]
+            for name, polygons in self.config.get("ice_sectors", {}).items()
+        }
+        assert not self.ice_polygons or set(self.ice_polygons) == set(
+            self.polygons
+        ), "ice_sectors should have the same names as sectors"
+        self.sector_ids = {name: key for key, name in enumerate(self.polygons, 1)}
+        assert len(self.sector_ids) < 128, "too many sectors for an int8 raster"
+        self.find_shelf_depth = self.config.get("shelf_depth", {})
+        self.bin_size = float(self.config.get("bin_size", 2.0))
+
+    def signature(self):
+        """json string of the sector definitions
+        Returns:
+            json string of the config
+        """
+        return json.dumps(self.config, sort_keys=True)
+
+    def contains(self, polygon, lat, lon):
+        """Test which points are inside a polygon with the even-odd rule,
+        vectorized over the points
+        Args:
+            polygon (np.array): (vertex, 2) array of longitude, latitude
+            lat, lon (np.array): 1D arrays of point coordinates
+        Returns:
+            boolean np.array, True for points inside the polygon
+        """
+        inside = np.zeros(lat.shape, dtype=bool)
+        lon1, lat1 = polygon[-1]
+        for lon2, lat2 in polygon:
+            crosses = (lat1 > lat) != (lat2 > lat)
+            if lat1 != lat2:
+                lon_cross = lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1)
+                inside ^= crosses & (lon < lon_cross)
+            lon1, lat1 = lon2, lat2
+        return inside
+
+    def classify(self, lat, lon, polygons=None):
+        """Classify points into sectors. Points are binned on a regular
+        longitude/latitude grid, so each polygon is only tested against the
+        points in the bins its bounding box overlaps. Later sectors in the
+        config take precedence where polygons overlap.
+        Args:
+            lat, lon (np.array): point coordinates in degrees
+            polygons (dict): sector name and polygons, the ocean polygons
+            if None
+        Returns:
+            labels (np.array): int8 sector id of each point, 0 outside all
+            sectors
+        """
+        shape = np.shape(lat)
+        lat = np.asarray(lat, dtype=float).ravel()
+        lon = np.asarray(lon, dtype=float).ravel() % 360
+        lon[lon >= 360] -= 360
+        if polygons is None:
+            polygons = self.polygons
+        labels = np.zeros(lat.size, dtype=np.int8)
+        num_cols = int(np.ceil(360 / self.bin_size))
+        num_rows = int(np.ceil(180 / self.bin_size))
+        cols = np.clip((lon / self.bin_size).astype(int), 0, num_cols - 1)
+        rows = np.clip(((lat + 90) / self.bin_size).astype(int), 0, num_rows - 1)
+        bins = rows * num_cols + cols
+        order = np.argsort(bins, kind="stable")
+        starts = np.searchsorted(bins[order], np.arange(num_rows * num_cols + 1))
+        for name, sector_polygons in polygons.items():
+            for polygon in sector_polygons:
+                col_lo, row_lo = np.floor(
+                    (polygon.min(axis=0) + [0, 90]) / self.bin_size
+                ).astype(int)
+                col_hi, row_hi = np.floor(
+                    (polygon.max(axis=0) + [0, 90]) / self.bin_size
+                ).astype(int)
+                col_lo, col_hi = np.clip([col_lo, col_hi], 0, num_cols - 1)
+                row_lo, row_hi = np.clip([row_lo, row_hi], 0, num_rows - 1)
+                candidates = np.concatenate(
+                    [
+                        order[
+                            starts[row * num_cols + col_lo] : starts[
+                                row * num_cols + col_hi + 1
+                            ]
+                        ]
+                        for row in range(row_lo, row_hi + 1)
+                    ]
+                )
+                inside = self.contains(polygon, lat[candidates], lon[candidates])
+                labels[candidates[inside]] = self.sector_ids[name]
+        return labels.reshape(shape)
+
+    def sector_masks(self, thetao_ds):
+        """select mask of each sector
+        Args:
+            thetao_ds (xarray dataset): dataset with latitude and longitude
+        Returns:
+            masks (dict): boolean xarray dataarray of each sector
+        """
+        labels = self.sector_raster(thetao_ds)
+        dims = thetao_ds.coords["latitude"].dims
+        masks = {
+            name: xr.DataArray(labels == key, dims=dims)
+            for name, key in self.sector_ids.items()
+        }
+        return masks
+
+    def sector_raster(self, area_ds):
+        """Build the int8 sector id raster of the ocean grid
+        Args:
+            area_ds (xarray dataset): areacello dataset
+        Returns:
+            labels (np.array): int8 sector id of each ocean cell
+        """
+        labels = self.classify(
+            area_ds.coords["latitude"].values, area_ds.coords["longitude"].values
+        )
+        return labels
+
+    def sector_mask(self, flags, sector):
+        """Select the mask of one sector from the sector id raster
+        Args:
+            flags (xarray dataarray): sector ids from sector_labels
+            sector (str): sector name
+        Returns:
+            mask (xarray dataarray): boolean mask of sector
+        """
+        return flags == self.sector_ids[sector]
+
+    def bisicles_labels(self, x, y, block_rows=512):
+        """Classify the cells of the BISICLES grid into sectors with the
+        ice_sectors polygons, projecting one block of rows at a time. The
+        ocean polygons only cover the continental shelf, so configs without
+        ice_sectors cannot label the ice sheet
+        Args:
+            x, y (np.array): co-ordinates of the grid cell centres in m
+            block_rows (int): number of rows classified at a time
+        Returns:
+            RegionLabels of the sectors, with ids in config order
+        """
+        assert self.ice_polygons, (
+            "No ice_sectors in " + self.config_file + ", cannot label the ice sheet"
+        )
+        names = {key: name for name, key in self.sector_ids.items()}
+        labels = np.zeros((len(y), len(x)), dtype=np.int8)
+        for start in range(0, len(y), block_rows):
+            y_block = y[start : start + block_rows]
+            lat, lon = self.polar_stereographic_latlon(x[None, :], y_block[:, None])
+            labels[start : start + block_rows] = self.classify(
+                lat, lon, self.ice_polygons
+            )
+        return RegionLabels(labels, names, x, y)